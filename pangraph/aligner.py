@@ -0,0 +1,211 @@
+import os
+import subprocess
+import numpy as np
+
+from itertools import islice
+
+from .utils import Strand, Hits, parse_paf_table, rev_cmpl
+
+# ------------------------------------------------------------------------
+# aligner backends
+# each backend maps a set of query sequences onto a set of reference
+# sequences, both given as dictionaries {name : sequence}, and returns the
+# hits as a utils.Hits table. passing the same dictionary as
+# queries and references requests a self-map. out is a path prefix that
+# backends may use for intermediate files.
+
+def write_fasta(path, seqs):
+    with open(path, 'w') as fd:
+        for name, seq in seqs.items():
+            fd.write(f">{name}\n{seq}\n")
+
+# ------------------------------------------------------------------------
+# minimap2 subprocess backend
+# -P retains all chains, as the mappy backend does, see MM_F_ALL_CHAINS: both
+# backends report the same hits.
+
+def write_inputs(qrys, refs, out):
+    qpath = f"{out}.qry.fa"
+    write_fasta(qpath, qrys)
+    if qrys is refs:
+        return qpath, qpath
+
+    rpath = f"{out}.ref.fa"
+    write_fasta(rpath, refs)
+    return qpath, rpath
+
+def minimap2(qrys, refs, out):
+    qpath, rpath = write_inputs(qrys, refs, out)
+
+    os.system(f"minimap2 -t 2 -x asm20 -m 10 -n 2 -s 30 -D -P -c {rpath} {qpath} 1>{out}.paf 2>log")
+
+    with open(f"{out}.paf") as fd:
+        return parse_paf_table(fd)
+
+# hits are parsed from the pipe as minimap2 reports them. the paf file is still written.
+def minimap2_stream(qrys, refs, out, chunk):
+    qpath, rpath = write_inputs(qrys, refs, out)
+
+    cmd = ["minimap2", "-t", "2", "-x", "asm20", "-m", "10", "-n", "2", "-s", "30", "-D", "-P", "-c", rpath, qpath]
+    with open("log", 'w') as log, open(f"{out}.paf", 'w') as paf:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log, text=True)
+        try:
+            while True:
+                lines = list(islice(proc.stdout, chunk))
+                if len(lines) == 0:
+                    break
+                paf.writelines(lines)
+                yield parse_paf_table(lines)
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+# ------------------------------------------------------------------------
+# in-memory mappy backend
+# mappy only indexes a single sequence held in memory. references are
+# concatenated, separated by a run of N's that never seeds, and hits are
+# mapped back onto the individual sequences.
+
+SPACER = 'N'*200
+
+# minimap2 flag (-P): keep all chains instead of choosing primary alignments.
+# mappy can not skip the trivial self-alignments of a self-map by name, as -D
+# does: the self-alignment of a block would otherwise suppress all of its other hits.
+MM_F_ALL_CHAINS = 0x800000
+
+# gap-compressed divergence, equivalent to the de:f tag of minimap2
+def divergence(cigar, nm, mlen):
+    gaps = [l for l, op in cigar if op == 1 or op == 2]
+    nmis = nm - sum(gaps)
+    return (nmis + len(gaps)) / (mlen + nmis + len(gaps))
+
+CIGAR_OPS = "MIDNSHP=X"
+
+# cuts the alignment of hit down to the reference interval [lo, hi) of the
+# concatenated index. returns the clipped (q_st, q_en, r_st, r_en, mlen, blen,
+# nm, cigar) with leading and trailing gaps trimmed, or None if no aligned
+# column is left. seq is the query, text the concatenated reference.
+def clip(hit, seq, text, lo, hi):
+    aln = seq[hit.q_st:hit.q_en]
+    if hit.strand == -1:
+        aln = rev_cmpl(aln)
+
+    cigar, r, q = [], hit.r_st, 0
+    for l, op in hit.cigar:
+        if op in (0, 7, 8):
+            a, b = max(r, lo), min(r + l, hi)
+            if a < b:
+                cigar.append((b - a, op, a, q + a - r))
+            r, q = r + l, q + l
+        elif op in (2, 3):
+            a, b = max(r, lo), min(r + l, hi)
+            if a < b:
+                cigar.append((b - a, op, a, q))
+            r = r + l
+        elif op == 1:
+            if lo < r < hi:
+                cigar.append((l, op, r, q))
+            q = q + l
+
+    while cigar and cigar[0][1] not in (0, 7, 8):
+        cigar.pop(0)
+    while cigar and cigar[-1][1] not in (0, 7, 8):
+        cigar.pop()
+    if len(cigar) == 0:
+        return None
+
+    mlen, blen, nm = 0, 0, 0
+    for l, op, r, q in cigar:
+        blen += l
+        if op in (0, 7, 8):
+            n     = sum(x == y for x, y in zip(aln[q:q+l], text[r:r+l]))
+            mlen += n
+            nm   += l - n
+        elif op != 3:
+            nm   += l
+
+    r_st, r_en = cigar[0][2], cigar[-1][2] + cigar[-1][0]
+    a_st, a_en = cigar[0][3], cigar[-1][3] + cigar[-1][0]
+    if hit.strand == 1:
+        q_st, q_en = hit.q_st + a_st, hit.q_st + a_en
+    else:
+        q_st, q_en = hit.q_en - a_en, hit.q_en - a_st
+
+    return q_st, q_en, r_st, r_en, mlen, blen, nm, [(l, op) for l, op, _, _ in cigar]
+
+# yields the hits as (qry, ref, row, cigar), see utils.PAF for the columns of row.
+def mappy_hits(qrys, refs):
+    import mappy as mp
+
+    names  = list(refs.keys())
+    offset = np.cumsum([0] + [len(refs[n]) + len(SPACER) for n in names])
+    text   = SPACER.join(refs[n] for n in names)
+    index  = mp.Aligner(seq=text,
+                        preset="asm20", min_cnt=2, min_chain_score=10, min_dp_score=30,
+                        extra_flags=MM_F_ALL_CHAINS)
+    if not index:
+        raise ValueError("failed to build mappy index")
+
+    for qry, seq in qrys.items():
+        for h in index.map(seq):
+            strand = Strand.Plus if h.strand == 1 else Strand.Minus
+            i      = np.searchsorted(offset, h.r_st, side='right') - 1
+            # alignment lies within a single reference
+            if h.r_en <= offset[i] + len(refs[names[i]]):
+                pieces = [(i, h.q_st, h.q_en, h.r_st, h.r_en, h.mlen, h.blen, h.NM, h.cigar, h.cigar_str)]
+            # alignment bridges the spacer: split it at the reference boundaries
+            else:
+                pieces = []
+                while i < len(names) and offset[i] < h.r_en:
+                    c = clip(h, seq, text, offset[i], offset[i] + len(refs[names[i]]))
+                    if c is not None:
+                        cigar_str = "".join(f"{l}{CIGAR_OPS[op]}" for l, op in c[7])
+                        pieces.append((i, *c, cigar_str))
+                    i += 1
+
+            for i, q_st, q_en, r_st, r_en, mlen, blen, nm, cigar, cigar_str in pieces:
+                ref = names[i]
+                beg, end = r_st - offset[i], r_en - offset[i]
+                # equivalent to minimap2 -D: drop trivial self-alignments
+                if qrys is refs and ref == qry and beg == q_st:
+                    continue
+
+                yield qry, ref, (len(seq), q_st, q_en, len(refs[ref]), beg, end,
+                                 mlen, blen, h.mapq, strand,
+                                 divergence(cigar, nm, mlen), np.nan), cigar_str
+
+def as_hits(hits):
+    ids, rows, cigars = {}, [], []
+    def intern(name):
+        if name not in ids:
+            ids[name] = len(ids)
+        return ids[name]
+
+    for qry, ref, row, cigar in hits:
+        rows.append((intern(qry), *row[0:3], intern(ref), *row[3:]))
+        cigars.append(cigar)
+
+    return Hits(rows, cigars, ids.keys())
+
+def mappy(qrys, refs, out):
+    return as_hits(mappy_hits(qrys, refs))
+
+def mappy_stream(qrys, refs, out, chunk):
+    hits = mappy_hits(qrys, refs)
+    while True:
+        paf = as_hits(islice(hits, chunk))
+        if len(paf) == 0:
+            break
+        yield paf
+
+backends = {
+    "minimap2" : minimap2,
+    "mappy"    : mappy,
+    # add more backends here...
+}
+
+# streaming variants: as above, but yield the hits in tables of at most chunk rows.
+streams = {
+    "minimap2" : minimap2_stream,
+    "mappy"    : mappy_stream,
+}
@@ -2,7 +2,8 @@ import numpy as np
 import numpy.random as rng
 
 from collections import defaultdict, Counter
-from .utils import parse_cigar, wcpair, as_array, as_string
+from contextlib  import contextmanager
+from .utils import parse_cigar, wcpair_lut, as_seq, as_string, rev_cmpl_seq
 
 # ------------------------------------------------------------------------
 # Helper functions
@@ -16,6 +17,95 @@ def randomid():
     return name
 randomid.N = 0
 
+# NOTE: forked worker processes inherit the state of RS.
+#       each must be reseeded to avoid generating colliding block ids.
+# a seed is a name, e.g. of a clade, or drawn by randomseed. it is hashed into the full
+# state of the generator by a SeedSequence: the ids of a run come from many streams and
+# two of them share a seed with negligible probability only.
+def stream(seed):
+    if isinstance(seed, str):
+        seed = int.from_bytes(seed.encode(), 'big')
+    return rng.MT19937(rng.SeedSequence(seed)).state
+
+def reseed(seed):
+    RS.set_state(stream(seed))
+
+# 128 bits, as four 32 bit words
+def randomseed():
+    return [int(w) for w in RS.randint(2**32, size=4, dtype=np.uint64)]
+
+# draws ids from the stream of seed within the context, then resumes the enclosing stream
+@contextmanager
+def reseeded(seed):
+    state = RS.get_state()
+    RS.set_state(stream(seed))
+    try:
+        yield
+    finally:
+        RS.set_state(state)
+
+# ------------------------------------------------------------------------
+# Mutations class: deviations of one haplotype from the block consensus
+# positions are sorted; values are ascii codes, see utils.as_seq.
+# tables are never modified in place and may be shared between blocks.
+
+GAP = ord('-')
+
+class Mutations(object):
+    """docstring for Mutations"""
+
+    def __init__(self, pos=None, val=None):
+        self.pos = np.zeros(0, dtype=np.int64) if pos is None else pos
+        self.val = np.zeros(0, dtype=np.uint8) if val is None else val
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __str__(self):
+        return str(self.to_dict())
+
+    def __repr__(self):
+        return str(self)
+
+    @classmethod
+    def from_dict(cls, d):
+        pos = np.fromiter((int(p) for p in d.keys()), dtype=np.int64, count=len(d))
+        val = as_seq("".join(d.values()))
+        idx = np.argsort(pos, kind='stable')
+        return cls(pos[idx], val[idx])
+
+    # tables must cover disjoint positions
+    @classmethod
+    def cat(cls, muts):
+        if len(muts) == 0:
+            return cls()
+        pos = np.concatenate([m.pos for m in muts])
+        val = np.concatenate([m.val for m in muts])
+        idx = np.argsort(pos, kind='stable')
+        return cls(pos[idx], val[idx])
+
+    def to_dict(self):
+        return {int(p):chr(v) for p, v in zip(self.pos, self.val)}
+
+    def shift(self, offset):
+        return Mutations(self.pos + offset, self.val)
+
+    def slice(self, start, stop):
+        i, j = np.searchsorted(self.pos, (start, stop))
+        return Mutations(self.pos[i:j] - start, self.val[i:j])
+
+    # L is the length of the consensus
+    def rev_cmpl(self, L):
+        return Mutations(L - 1 - self.pos[::-1], wcpair_lut[self.val[::-1]])
+
+    def num_gaps(self):
+        return int(np.count_nonzero(self.val == GAP))
+
+    def apply(self, seq):
+        tmp = np.copy(seq)
+        tmp[self.pos] = self.val
+        return tmp
+
 # ------------------------------------------------------------------------
 # Block class
 
@@ -25,7 +115,7 @@ class Block(object):
     def __init__(self, gen=True):
         super(Block, self).__init__()
         self.id   = randomid() if gen else 0
-        self.seq  = None
+        self.seq  = None # consensus as ascii codes, see utils.as_seq
         # self.pos  = {}
         self.muts = {}
 
@@ -56,8 +146,8 @@ class Block(object):
     @classmethod
     def from_seq(cls, name, seq):
         new_blk      = cls()
-        new_blk.seq  = as_array(seq)
-        new_blk.muts = {(name, 0):{}}
+        new_blk.seq  = as_seq(seq)
+        new_blk.muts = {(name, 0):Mutations()}
 
         return new_blk
 
@@ -69,8 +159,8 @@ class Block(object):
 
         B      = Block()
         B.id   = d['id']
-        B.seq  = as_array(d['seq'])
-        B.muts = {unpack(k):{int(x):sub for x, sub in v.items()} for k, v in d['muts'].items()}
+        B.seq  = as_seq(d['seq'])
+        B.muts = {unpack(k):Mutations.from_dict(v) for k, v in d['muts'].items()}
 
         return B
 
@@ -80,12 +170,10 @@ class Block(object):
         assert all([blks[0].muts.keys() == b.muts.keys() for b in blks[1:]])
 
         nblk.seq  = np.concatenate([b.seq for b in blks])
-        nblk.muts = { blks[0]: { s:dict(x) for s,x in blks[0].muts.items() }}
+        nblk.muts = { blks[0]: dict(blks[0].muts) }
         offset    = len(blks[0])
         for b in blks[1:]:
-            nblk.muts[b] = {}
-            for s in b.muts.keys():
-                nblk.muts[b][s] = {(x+offset):snp for x,snp in b.muts[s].items()}
+            nblk.muts[b] = {s:m.shift(offset) for s, m in b.muts.items()}
             offset += len(b)
 
         return nblk
@@ -93,23 +181,27 @@ class Block(object):
     @classmethod
     def from_aln(cls, aln, debug=False):
         def updatemuts(blk, xtramuts, xmap, omuts, ival):
-            seq = blk.seq
+            seq  = blk.seq
+            xtra = Mutations(*xtramuts)
             # Iterate over all sequences in the block
             isomap = {}
             for iso, muts in omuts.items():
                 # Shift position by indel #'s
-                opos = as_array(m for m in muts.keys() if m >= ival[0] and m < ival[1])
+                i, j = np.searchsorted(muts.pos, ival)
+                opos = muts.pos[i:j]
+                oval = muts.val[i:j]
                 npos = opos + xmap[1][np.searchsorted(xmap[0], opos, side='right')]
 
                 assert (np.max(npos) if len(npos) > 0 else 0) < len(seq)
 
-                newmuts = {np : muts[op] for np, op in zip(npos, opos)}
-                for p, n in xtramuts.items():
-                    if p in newmuts:
-                        if newmuts[p] == seq[p]:
-                            newmuts.pop(p)
-                    else:
-                        newmuts[p] = n
+                # where the consensus changed, old mutations equal to the new consensus vanish.
+                # elsewhere the haplotype inherits the difference between the two consensus.
+                inxtra = np.isin(npos, xtra.pos)
+                keep   = ~(inxtra & (oval == seq[npos]))
+                new    = ~np.isin(xtra.pos, npos)
+
+                newmuts = Mutations.cat([Mutations(npos[keep], oval[keep]),
+                                         Mutations(xtra.pos[new], xtra.val[new])])
 
                 isomap[iso] = blk.push(iso, newmuts)
 
@@ -154,7 +246,7 @@ class Block(object):
         if keepname:
             b.name = self.name
         b.seq  = np.copy(self.seq)
-        b.muts = {s:dict(self.muts[s]) for s in self.muts}
+        b.muts = dict(self.muts)
 
         return b
 
@@ -164,51 +256,40 @@ class Block(object):
         return self
 
     def extract(self, iso, num, strip_gaps=True, verbose=False):
-        tag = (iso, num)
-        tmp = np.copy(self.seq)
-        for key, muts in self.muts.items():
-            if not isinstance(key, tuple):
-                continue
-            for x in muts.keys():
-                if x >= len(tmp):
-                    import ipdb; ipdb.set_trace()
+        return as_string(self.haplotype(iso, num, strip_gaps))
 
-        for p, s in self.muts[tag].items():
-            tmp[p] = s
+    # sequence of one haplotype as ascii codes
+    def haplotype(self, iso, num, strip_gaps=True):
+        muts = self.muts[(iso, num)]
+        assert len(muts) == 0 or muts.pos[-1] < len(self.seq), "mutation out of bounds"
 
-        assert len(tmp) > 0, "empty sequence"
+        seq = muts.apply(self.seq)
+        assert len(seq) > 0, "empty sequence"
 
-        if strip_gaps:
-            return as_string(tmp[tmp != '-'])
-        else:
-            return as_string(tmp)
+        return seq[seq != GAP] if strip_gaps else seq
 
     def len_of(self, iso, num):
         tag    = (iso, num)
         length = len(self.seq)
-        gaplen = sum(1 for s in self.muts[tag].values() if s == '-')
+        gaplen = self.muts[tag].num_gaps()
         return length - gaplen
 
     def is_empty(self, iso, num, strip_gaps=True):
         tag = (iso, num)
-        seq = np.copy(self.seq)
         # NOTE: This is a hack. Need to investigate the error that arises.
         if tag not in self.muts:
             return True
 
-        for p, s in self.muts[tag].items():
-            seq[p] = s
+        seq = self.muts[tag].apply(self.seq)
 
-        return len(seq) == 0 or all(nuc == "-" for nuc in seq)
+        return len(seq) == 0 or np.all(seq == GAP)
 
-    def rev_cmpl(self):
-        from Bio import Seq
-
-        nblk     = Block()
-        nblk.seq = as_array(Seq.reverse_complement("".join(self.seq)))
-        L        = len(self.seq)-1
+    def rev_cmpl(self, gen=True):
+        nblk     = Block(gen=gen)
+        nblk.seq = rev_cmpl_seq(self.seq)
+        L        = len(self.seq)
         for s in self.muts:
-            nblk.muts[s] = {L-p: wcpair.get(c,c) for p,c in self.muts[s].items()}
+            nblk.muts[s] = self.muts[s].rev_cmpl(L)
 
         return nblk
 
@@ -234,25 +315,25 @@ class Block(object):
         def pack(key):
             return f"{key[0]}?###?{key[1]}"
 
-        def fix(d):
-            return {int(k):v for k, v in d.items()}
-
         return {'id'   : self.id,
-                'seq'  : "".join(str(n) for n in self.seq),
-                'muts' : {pack(k) : fix(v) for k, v in self.muts.items()}}
+                'seq'  : as_string(self.seq),
+                'muts' : {pack(k) : v.to_dict() for k, v in self.muts.items()}}
 
     def __len__(self):
         return len(self.seq)
 
     def __getitem__(self, val):
         if isinstance(val, slice):
-            b     = Block()
-            start = val.start or 0
-            stop  = val.stop or len(self.seq)
-            b.seq = self.seq[start:stop]
-            # b.pos = { iso : start+val.start for iso,start in self.pos.items() }
-            for s, _ in self.muts.items():
-                b.muts[s] = {p-start:c for p,c in self.muts[s].items() if p>=start and p<stop}
-            return b
+            return self.slice(val.start or 0, val.stop or len(self.seq))
         else:
             raise ValueError("item access not supported")
+
+    # the segment [start, stop) as a new block. gen=False leaves the id unset: segments that are
+    # only read, e.g. by Graph.hit_alignment, do not draw from the block id generator.
+    def slice(self, start, stop, gen=True):
+        b     = Block(gen=gen)
+        b.seq = self.seq[start:stop]
+        # b.pos = { iso : start+val.start for iso,start in self.pos.items() }
+        for s, m in self.muts.items():
+            b.muts[s] = m.slice(start, stop)
+        return b
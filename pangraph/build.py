@@ -6,6 +6,7 @@ import builtins
 
 from .utils import mkdir, log
 from .tree import Tree
+from .     import columnar
 
 def open(path, *args, **kwargs):
     if path == '-':
@@ -47,6 +48,23 @@ def register_args(parser):
                         type=int,
                         default=1000,
                         help="amount of sequence to extend for end repair")
+    parser.add_argument("-a", "--aligner",
+                        metavar="aligner",
+                        type=str,
+                        default="minimap2",
+                        choices=['minimap2', 'mappy'],
+                        help="backend used to map blocks. 'mappy' aligns in memory through the minimap2 python bindings")
+    parser.add_argument("-S", "--stream",
+                        metavar="queue size",
+                        type=int,
+                        default=0,
+                        help="if positive, hits are merged while the aligner still runs: the best hits are taken whenever more than this number are queued. trades the global ordering of hits for memory and overlap of alignment with merging")
+    parser.add_argument("-v", "--verify",
+                        metavar="check level",
+                        type=str,
+                        default="full",
+                        choices=['off', 'hash', 'sampled', 'full'],
+                        help="how the reconstruction of the input sequences is checked after each merge. 'hash' compares hashes of graph segments instead of full sequences, 'sampled' fully checks a random subset of isolates")
     parser.add_argument("-c", "--circular",
                         default=False,
                         action='store_true',
@@ -55,6 +73,19 @@ def register_args(parser):
                         default=False,
                         action='store_true',
                         help="boolean flag that toggles whether the graph statistics are computed for intermediate graphs")
+    parser.add_argument("-j", "--jobs",
+                        metavar="number of workers",
+                        type=int,
+                        default=1,
+                        help="number of worker processes used to align independent subtrees in parallel")
+    parser.add_argument("-r", "--resume",
+                        default=False,
+                        action='store_true',
+                        help="resume an interrupted run from the checkpoints of the latest tmp directory (or the one set by --num). delete a clade's checkpoint to recompute it")
+    parser.add_argument("-B", "--binary",
+                        default=False,
+                        action='store_true',
+                        help="also write each graph as graph_###.pgb in the binary columnar format, which loads through a memory map. see pangraph.columnar")
     parser.add_argument("-n", "--num",
                         type=int,
                         default=-1,
@@ -83,25 +114,31 @@ def main(args):
     tmp  = f"{root}/tmp"
     if args.num == -1:
         i    = 0
+        last = None
         while os.path.isdir(tmp) and i < 64:
+            last = tmp
             i += 1
             tmp = f"{root}/tmp{i:03d}"
+        if args.resume and last is not None:
+            tmp = last
     else:
             tmp = f"{root}/tmp{args.num:03d}"
     mkdir(tmp)
 
     log("aligning")
-    T.align(tmp, args.len, args.circular, args.mu, args.beta, args.extensive, args.window, args.extend, args.statistics)
+    T.align(tmp, args.len, args.circular, args.mu, args.beta, args.extensive, args.window, args.extend, args.statistics, nprocs=args.jobs, resume=args.resume, aligner=args.aligner, verify=args.verify, stream=args.stream)
     # TODO: when debugging phase is done, remove tmp directory
 
-    graphs = T.collect()
+    graphs, sizes = T.collect()
 
-    for i, g in enumerate(graphs):
-        log(f"graph {i}: nseqs: {len(g.seqs)} nblks: {len(g.blks)}")
+    for i, size in enumerate(sizes):
+        log(f"graph {i}: nseqs: {size['nseqs']} nblks: {size['nblks']} length: {size['length']}")
 
     for i, g in enumerate(graphs):
         with open(f"{root}/graph_{i:03d}.fa", 'w') as fd:
             g.write_fasta(fd)
+        if args.binary:
+            columnar.write(f"{root}/graph_{i:03d}.pgb", g)
 
     # NOTE: uncomment when done debugging
     T.write_json(sys.stdout, no_seqs=True)
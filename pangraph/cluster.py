@@ -7,6 +7,10 @@ import json
 import subprocess as spawn
 import tempfile
 
+from collections        import deque
+from contextlib         import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import matplotlib.pylab as plt
 
@@ -28,8 +32,13 @@ def register_args(parser):
                         type=str,
                         nargs='?',
                         default="mash",
-                        choices=['mash', 'random'],
-                        help="backend used to estimate inter-sequence distance")
+                        choices=['mash', 'minhash', 'random'],
+                        help="backend used to estimate inter-sequence distance. 'minhash' sketches the sequences natively, without mash")
+    parser.add_argument("-j", "--jobs",
+                        metavar="number of workers",
+                        type=int,
+                        default=1,
+                        help="number of worker processes used to estimate distances")
     parser.add_argument("input",
                         type=str,
                         nargs='*',
@@ -42,8 +51,8 @@ def register_args(parser):
 # mash backend
 
 # NOTE: mash takes '-' as filename if it is to read from stdin
-def run_mash(inpath):
-    stdout = spawn.check_output(f"mash triangle {inpath} 2>/dev/null", shell=True)
+def run_mash(inpath, nprocs=1):
+    stdout = spawn.check_output(f"mash triangle -p {nprocs} {inpath} 2>/dev/null", shell=True)
     return io.StringIO(stdout.decode("utf-8"))
 
 def parse_mash(input):
@@ -60,10 +69,110 @@ def parse_mash(input):
     input.close()
     return M, np.array(names)
 
+# ------------------------------------------------------------------------
+# minhash backend
+# native estimate of the mash distance, see Ondov et al. (2016). each record is
+# reduced to the SKETCH smallest hashes of its canonical K-mers. records are
+# streamed from the input files and sketched in worker processes.
+
+K      = 21
+SKETCH = 1000
+
+# 2 bit codes of nucleotides. any other character is 4 and breaks the k-mers it is part of.
+CODE = np.full(256, 4, dtype=np.uint64)
+CODE[np.frombuffer(b"ACGTacgt", dtype=np.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+
+# bijective 64 bit mixer, see splitmix64
+def mix(x):
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+# packed canonical k-mers of a sequence, i.e. the smaller of each k-mer and its reverse complement.
+# all windows are built at once by k shifts of the code array.
+def kmers(seq, k=K):
+    code = CODE[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    n    = len(code) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    fwd = np.zeros(n, dtype=np.uint64)
+    rev = np.zeros(n, dtype=np.uint64)
+    for t in range(k):
+        c    = code[t:t+n] & np.uint64(3)
+        fwd  = (fwd << np.uint64(2)) | c
+        rev |= (np.uint64(3) - c) << np.uint64(2*t)
+
+    bad = np.concatenate(([0], np.cumsum(code > 3)))
+    return np.minimum(fwd, rev)[bad[k:] == bad[:-k]]
+
+def sketch(seq, k=K, size=SKETCH):
+    return np.unique(mix(kmers(seq, k)))[:size]
+
+# escaped names and sequences of all records of the input files
+def records(files):
+    for file in files:
+        with openany(file, 'r') as fd:
+            for s in SeqIO.parse(fd, 'fasta'):
+                yield escape("_".join(s.description.split())), str(s.seq)
+
+# input holds the (name, sequence) records, see records
+def run_minhash(input, nprocs=1):
+    names, sketches = [], []
+    with ProcessPoolExecutor(max_workers=nprocs) if nprocs > 1 else nullcontext() as pool:
+        # at most 2*nprocs records are held in memory at once
+        queue = deque()
+        for name, seq in input:
+            names.append(name)
+            if pool is None:
+                sketches.append(sketch(seq))
+                continue
+
+            queue.append(pool.submit(sketch, seq))
+            if len(queue) >= 2*nprocs:
+                sketches.append(queue.popleft().result())
+        while len(queue) > 0:
+            sketches.append(queue.popleft().result())
+
+    return names, sketches
+
+# the jaccard index of two records is estimated on the SKETCH smallest hashes of their union.
+# each row compares one sketch against all later ones: an element of sketch B at rank k
+# has rank k + |A < b| - |A ∩ B < b| in the union of A and B.
+def parse_minhash(input):
+    names, sketches = input
+    N    = len(names)
+    size = np.array([len(s) for s in sketches], dtype=np.int64)
+    S    = np.zeros((N, SKETCH), dtype=np.uint64)
+    for i, s in enumerate(sketches):
+        S[i, :len(s)] = s
+
+    M    = np.zeros((N, N), dtype=float)
+    rank = np.arange(SKETCH)
+    for i in range(N-1):
+        A, B = sketches[i], S[i+1:]
+        if len(A) == 0:
+            M[i, i+1:] = 1
+            continue
+
+        c      = np.searchsorted(A, B)
+        hit    = (rank[None, :] < size[i+1:, None]) & (A[np.minimum(c, len(A)-1)] == B)
+        before = np.cumsum(hit, axis=1) - hit
+        common = np.sum(hit & (rank[None, :] + c - before < SKETCH), axis=1)
+        union  = np.minimum(SKETCH, len(A) + size[i+1:] - np.sum(hit, axis=1))
+
+        J = common / np.maximum(union, 1)
+        with np.errstate(divide='ignore'):
+            M[i, i+1:] = np.where(J > 0, -np.log(2*J/(1+J)) / K, 1)
+
+    M = M + M.T
+
+    return M, np.array(names)
+
 # ------------------------------------------------------------------------
 # random matrix backend
 
-def nop(input):
+def nop(input, nprocs=1):
     return input
 
 def random_matrix(input):
@@ -79,14 +188,18 @@ def random_matrix(input):
 # ------------------------------------------------------------------------
 # backends perform the pairwise distance approximation
 
+# merged backends read all input files rewritten into a single fasta file.
+# the others are passed the records of the input, read once, see records.
 class Backend(object):
-    def __init__(self, run, parse):
-        self.run   = run
-        self.parse = parse
+    def __init__(self, run, parse, merged=True):
+        self.run    = run
+        self.parse  = parse
+        self.merged = merged
 
 backends = {
-    "mash"   : Backend(run=run_mash, parse=parse_mash),
-    "random" : Backend(run=nop, parse=random_matrix),
+    "mash"    : Backend(run=run_mash, parse=parse_mash),
+    "minhash" : Backend(run=run_minhash, parse=parse_minhash, merged=False),
+    "random"  : Backend(run=nop, parse=random_matrix),
     # add more backends here...
 }
 
@@ -125,21 +238,27 @@ def main(args):
     outdir  = args.dir.rstrip("/")
 
     tmp = None
-    if isinstance(args.input, list):
+    if isinstance(args.input, list) and backend.merged:
         tmp = tempfile.NamedTemporaryFile('w', delete=True)
         for file in args.input:
             with openany(file, 'r') as fd:
                 seqs = [SeqRecord(id = escape("_".join(s.description.split())), name = s.description, seq = s.seq) for s in SeqIO.parse(fd, 'fasta')]
                 SeqIO.write(seqs, tmp, "fasta")
         input = tmp.name
-    else:
+    elif backend.merged:
         input = args.input
+    else:
+        # the input is read once: it may be a stream, e.g. stdin
+        input = list(records(args.input if isinstance(args.input, list) else [args.input]))
 
-    dist, names = backend.parse(backend.run(input))
+    dist, names = backend.parse(backend.run(input, args.jobs))
     tree = Tree.nj(dist, names)
 
-    with openany(input, 'r') as fd:
-        seqs = {s.id : s.seq for s in SeqIO.parse(fd, "fasta")}
+    if backend.merged:
+        with openany(input, 'r') as fd:
+            seqs = {s.id : s.seq for s in SeqIO.parse(fd, "fasta")}
+    else:
+        seqs = dict(input)
     tree.attach(seqs)
 
     if tmp:
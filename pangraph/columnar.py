@@ -0,0 +1,260 @@
+"""
+binary columnar file format for pangraphs, loaded through a memory map
+"""
+import json
+import numpy as np
+
+from collections import OrderedDict
+
+from .block    import Block, Mutations
+from .sequence import Node, Path
+from .graph    import Graph
+from .utils    import Strand
+
+# ------------------------------------------------------------------------
+# Layout
+#   MAGIC | header length (uint64) | json header | columns
+# the header holds the graph metadata and {column : (dtype, shape, offset)}.
+# every column starts at a multiple of ALIGN bytes from the start of the file.
+#
+# variable length records are stored as one flat column plus an offset column
+# with one more entry than records: record i is flat[off[i]:off[i+1]].
+#   names      : isolate names, utf-8
+#   blk_ids    : block ids, utf-8
+#   blk_seq    : block consensus sequences as ascii codes, indexed by blk_off
+#   blk_mut    : mutation tables of each block, as rows of mut_*
+#   mut_iso    : isolate of each table, as index into names
+#   mut_num    : copy number of each table
+#   mut_pos    : mutation positions, indexed by mut_off
+#   mut_val    : mutation values, indexed by mut_off
+#   path_name  : isolate of each path, as index into names
+#   path_start : offset of each path, see Path.offset
+#   path_circ  : circularity of each path
+#   node_blk   : block of each node, as index into blk_ids, indexed by path_off
+#   node_num   : copy number of each node
+#   node_strand: strand of each node
+
+MAGIC   = b"PANGRAPH"
+VERSION = 1
+ALIGN   = 64
+
+# ------------------------------------------------------------------------
+# Helper functions
+
+def pack_strings(strs):
+    raw = [s.encode() for s in strs]
+    off = np.zeros(len(raw)+1, dtype=np.int64)
+    off[1:] = np.cumsum([len(r) for r in raw])
+    return np.frombuffer(b"".join(raw), dtype=np.uint8), off
+
+def unpack_strings(buf, off):
+    raw = bytes(buf)
+    return [raw[off[i]:off[i+1]].decode() for i in range(len(off)-1)]
+
+def offsets(lens):
+    off = np.zeros(len(lens)+1, dtype=np.int64)
+    off[1:] = np.cumsum(lens)
+    return off
+
+def concat(arrs, dtype):
+    return np.concatenate(arrs).astype(dtype, copy=False) if len(arrs) > 0 else np.zeros(0, dtype=dtype)
+
+# ------------------------------------------------------------------------
+# Exporter
+
+def columns(G):
+    blks  = list(G.blks.values())
+    index = {b.id:i for i, b in enumerate(blks)}
+    paths = list(G.seqs.values())
+
+    names = {p.name:None for p in paths}
+    for b in blks:
+        names.update({tag[0]:None for tag in b.muts})
+    names = {n:i for i, n in enumerate(names)}
+
+    cols = {}
+    cols['names'],   cols['names_off']   = pack_strings(names.keys())
+    cols['blk_ids'], cols['blk_ids_off'] = pack_strings([b.id for b in blks])
+
+    cols['blk_seq'] = concat([b.seq for b in blks], np.uint8)
+    cols['blk_off'] = offsets([len(b.seq) for b in blks])
+
+    tags = [(tag, m) for b in blks for tag, m in b.muts.items()]
+    cols['blk_mut'] = offsets([len(b.muts) for b in blks])
+    cols['mut_iso'] = np.array([names[tag[0]] for tag, _ in tags], dtype=np.int64)
+    cols['mut_num'] = np.array([tag[1] for tag, _ in tags], dtype=np.int64)
+    cols['mut_pos'] = concat([m.pos for _, m in tags], np.int64)
+    cols['mut_val'] = concat([m.val for _, m in tags], np.uint8)
+    cols['mut_off'] = offsets([len(m) for _, m in tags])
+
+    cols['path_name']   = np.array([names[p.name] for p in paths], dtype=np.int64)
+    cols['path_start']  = np.array([p.offset for p in paths], dtype=np.int64)
+    cols['path_circ']   = np.array([p.circular for p in paths], dtype=np.bool_)
+    cols['path_off']    = offsets([len(p.nodes) for p in paths])
+    cols['node_blk']    = np.array([index[n.blk.id] for p in paths for n in p.nodes], dtype=np.int64)
+    cols['node_num']    = np.array([n.num for p in paths for n in p.nodes], dtype=np.int64)
+    cols['node_strand'] = np.array([int(n.strand) for p in paths for n in p.nodes], dtype=np.int8)
+
+    return cols
+
+def write(path, G):
+    cols = columns(G)
+
+    meta, offset = {}, 0
+    for key, col in cols.items():
+        meta[key] = (col.dtype.str, col.shape, offset)
+        offset   += -(-col.nbytes // ALIGN) * ALIGN
+
+    header = json.dumps({'version' : VERSION,
+                         'name'    : G.name,
+                         'suffix'  : None if G.sfxt is None else "compiled",
+                         'distmtx' : G.dmtx,
+                         'columns' : meta}).encode()
+    start  = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    with open(path, 'wb') as fd:
+        fd.write(MAGIC)
+        fd.write(np.uint64(len(header)).tobytes())
+        fd.write(header)
+        for key, col in cols.items():
+            fd.seek(start + meta[key][2])
+            fd.write(np.ascontiguousarray(col).tobytes())
+        fd.truncate(start + offset)
+
+# ------------------------------------------------------------------------
+# Importer
+
+# returns the header and the columns of the file as read-only views of a memory map
+def open_columns(path):
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f"{path} is not a binary pangraph")
+
+    n      = int(buf[len(MAGIC):len(MAGIC)+8].view(np.uint64)[0])
+    header = json.loads(bytes(buf[len(MAGIC)+8:len(MAGIC)+8+n]))
+    if header['version'] != VERSION:
+        raise ValueError(f"unsupported binary pangraph version {header['version']}")
+
+    start = -(-(len(MAGIC) + 8 + n) // ALIGN) * ALIGN
+    cols  = {}
+    for key, (dtype, shape, offset) in header['columns'].items():
+        dtype = np.dtype(dtype)
+        size  = int(np.prod(shape)) * dtype.itemsize
+        cols[key] = buf[start+offset:start+offset+size].view(dtype).reshape(shape)
+
+    return header, cols
+
+def block_at(cols, names, ids, i):
+    so, mo = cols['blk_off'], cols['mut_off']
+    pos, val = cols['mut_pos'], cols['mut_val']
+    iso, num = cols['mut_iso'], cols['mut_num']
+
+    b      = Block(gen=False)
+    b.id   = ids[i]
+    b.seq  = cols['blk_seq'][so[i]:so[i+1]]
+    b.muts = {(names[iso[t]], int(num[t])) : Mutations(pos[mo[t]:mo[t+1]], val[mo[t]:mo[t+1]])
+                for t in range(cols['blk_mut'][i], cols['blk_mut'][i+1])}
+    return b
+
+# blk(i) returns the block with index i
+def path_at(cols, names, blk, i):
+    po    = cols['path_off']
+    name  = names[cols['path_name'][i]]
+    nodes = [Node(blk(b), n, Strand(s)) for b, n, s in zip(cols['node_blk'][po[i]:po[i+1]].tolist(),
+                                                         cols['node_num'][po[i]:po[i+1]].tolist(),
+                                                         cols['node_strand'][po[i]:po[i+1]].tolist())]
+    return Path(name, nodes, int(cols['path_start'][i]), bool(cols['path_circ'][i]))
+
+# sequences and mutation tables of the returned graph are views of the file and are not copied
+def load(path):
+    header, cols = open_columns(path)
+
+    names = unpack_strings(cols['names'], cols['names_off'])
+    ids   = unpack_strings(cols['blk_ids'], cols['blk_ids_off'])
+    blks  = [block_at(cols, names, ids, i) for i in range(len(ids))]
+    seqs  = [path_at(cols, names, blks.__getitem__, i) for i in range(len(cols['path_name']))]
+
+    G = Graph()
+    G.name = header['name']
+    G.blks = {b.id : b for b in blks}
+    G.seqs = {p.name : p for p in seqs}
+    if header['suffix'] is not None:
+        G.compile_suffix()
+        G.dmtx = header['distmtx']
+
+    return G
+
+# ------------------------------------------------------------------------
+# Reader class: random access to the blocks and paths of a file
+# only the requested objects are built. the most recently used are kept in a
+# cache of the given size; the rest of the graph stays on disk.
+
+class Reader(object):
+    """docstring for Reader"""
+
+    def __init__(self, path, cache=256):
+        self.file   = path
+        self.header, self.cols = open_columns(path)
+
+        self.names  = unpack_strings(self.cols['names'], self.cols['names_off'])
+        self.ids    = unpack_strings(self.cols['blk_ids'], self.cols['blk_ids_off'])
+        self.blkidx = {id:i for i, id in enumerate(self.ids)}
+        self.seqidx = {self.names[n]:i for i, n in enumerate(self.cols['path_name'])}
+
+        self.size   = cache
+        self.cache  = OrderedDict() # (kind, index) -> Block or Path, in order of last use
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self.blkidx
+
+    @property
+    def name(self):
+        return self.header['name']
+
+    def isolates(self):
+        return list(self.seqidx.keys())
+
+    def blocks(self):
+        return list(self.ids)
+
+    def lookup(self, key, build):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        val = build()
+        self.cache[key] = val
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return val
+
+    def block_at(self, i):
+        return self.lookup(('blk', i), lambda: block_at(self.cols, self.names, self.ids, i))
+
+    def block(self, id):
+        if id not in self.blkidx:
+            raise KeyError(f"block {id} not found in {self.file}")
+        return self.block_at(self.blkidx[id])
+
+    # nodes of the path reference the cached blocks
+    def path(self, name):
+        if name not in self.seqidx:
+            raise KeyError(f"isolate {name} not found in {self.file}")
+        i = self.seqidx[name]
+        return self.lookup(('seq', i), lambda: path_at(self.cols, self.names, self.block_at, i))
+
+    def extract(self, name):
+        return self.path(name).sequence()
+
+    def block_length(self, id):
+        so = self.cols['blk_off']
+        i  = self.blkidx[id]
+        return int(so[i+1] - so[i])
+
+    def block_depth(self, id):
+        bm = self.cols['blk_mut']
+        i  = self.blkidx[id]
+        return int(bm[i+1] - bm[i])
@@ -2,15 +2,20 @@ import io, os, sys
 import json
 import numpy as np
 import pprint
+import heapq
 import subprocess
 import tempfile
 
 from io          import StringIO
+from contextlib  import nullcontext
 from glob        import glob
 from collections import defaultdict, Counter
 from itertools   import chain
 from copy        import deepcopy
 
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing    import RawArray
+
 from Bio           import AlignIO, SeqIO, Phylo
 from Bio.Seq       import Seq
 from Bio.SeqRecord import SeqRecord
@@ -18,9 +23,10 @@ from Bio.SeqRecord import SeqRecord
 from scipy.stats import entropy
 
 from .         import suffix
-from .block    import Block
+from .         import aligner as aligners
+from .block    import Block, reseeded, randomseed
 from .sequence import Node, Path
-from .utils    import Strand, as_string, parse_paf, panic, as_record, new_strand, breakpoint
+from .utils    import Strand, as_string, as_cigar, panic, as_record, new_strand, breakpoint, rev_cmpl, DisjointSet
 
 # ------------------------------------------------------------------------
 # globals
@@ -30,6 +36,13 @@ pp = pprint.PrettyPrinter(indent=4)
 # ------------------------------------------------------------------------
 # utility
 
+# runs Block.from_aln with ids drawn from the stream of seed. the block id generator of
+# a forked worker is a copy of the parent's and is reseeded to avoid colliding ids; the
+# serial path draws from the same streams so that the graph does not depend on nprocs.
+def blocks_from_aln(aln, seed):
+    with reseeded(seed):
+        return Block.from_aln(aln)
+
 def alignment_entropy(rdr):
     try:
         aln = np.array([list(rec) for rec in AlignIO.read(rdr, 'fasta')], np.character).view(np.uint8)
@@ -39,6 +52,32 @@ def alignment_entropy(rdr):
         print(f"ERROR: {msg}")
         return None
 
+# distances of the pairs (i, j < i) of the given rows, see Graph.pairwise_distance.
+# weights[iso] = (block indices, lengths, total length) with the indices sorted.
+def fill_distances(D, index, isos, weights, rows):
+    for i in rows:
+        for j in range(i):
+            mums = index.tokens(isos[i], isos[j])
+            if weights is None:
+                D[i,j] = len(mums) if len(mums) > 0 else np.inf
+            else:
+                blks = np.array([t >> 1 for m in mums for t in m], dtype=np.int64)
+                def frac(iso):
+                    keys, lens, L = weights[iso]
+                    return lens[np.searchsorted(keys, blks)].sum() / L
+                D[i,j] = np.sqrt(frac(isos[i])*frac(isos[j]))
+            D[j,i] = D[i,j]
+
+# the match index and the output matrix are handed once to each worker process.
+# the matrix is shared memory: rows are disjoint across batches, so workers never write the same entry.
+distances = {}
+def init_distances(index, isos, weights, buf):
+    N = len(isos)
+    distances.update(index=index, isos=isos, weights=weights, D=np.frombuffer(buf).reshape(N, N))
+
+def distances_of(rows):
+    fill_distances(distances['D'], distances['index'], distances['isos'], distances['weights'], rows)
+
 # ------------------------------------------------------------------------
 # Junction class
 # simple struct
@@ -106,6 +145,7 @@ class Graph(object):
         self.seqs = {}   # All sequences (as list of blocks)
         self.sfxt = None # Suffix tree of block records
         self.dmtx = None # Graph distance matrix
+        self.occs = None # Occurrence index of blocks along paths, see index_blks
 
     # --- Class methods ---
 
@@ -135,35 +175,43 @@ class Graph(object):
 
         return G
 
+    # splits G into the subgraphs of sequences that share blocks. blocks and sequences are joined
+    # in a disjoint-set forest. returns the components in order of their first sequence and their
+    # sizes {'nseqs', 'nblks', 'length'}.
     @classmethod
     def connected_components(cls, G):
         # -----------------------------
         # internal functions
-        def overlaps(s1, s2):
-            return len(s1.intersection(s2)) > 0
-        def component(graph, name):
+        def component(blks, names):
             cc = Graph()
-            cc.blks = {id:G.blks.pop(id) for id in graph}
-            cc.seqs = {nm:G.seqs.pop(nm) for nm in name}
+            cc.blks = {id:G.blks.pop(id) for id in blks}
+            cc.seqs = {nm:G.seqs.pop(nm) for nm in names}
             cc.sfxt = None
             cc.dmtx = None
             return cc
 
         # -----------------------------
         # main body
-        graphs, names = [], []
+        # sequences are keyed by 1-tuples to keep them apart from block ids
+        dsu = DisjointSet()
         for name, path in G.seqs.items():
-            blks = set([b.id for b in path.blocks()])
-            gi   = [i for i, g in enumerate(graphs) if overlaps(blks, g)]
-            if len(gi) == 0:
-                graphs.append(blks)
-                names.append(set([name]))
-                continue
+            dsu.add((name,))
+            for n in path.nodes:
+                dsu.add(n.blk.id)
+                dsu.union((name,), n.blk.id)
+
+        blks, names = defaultdict(list), defaultdict(list)
+        for name in G.seqs:
+            names[dsu.find((name,))].append(name)
+        for id in G.blks:
+            if id in dsu:
+                blks[dsu.find(id)].append(id)
 
-            graphs[gi[0]] = graphs[gi[0]].union(blks, *(graphs.pop(i) for i in gi[:0:-1]))
-            names[gi[0]]  = names[gi[0]].union(set([name]), *(names.pop(i) for i in gi[:0:-1]))
+        sizes = [{'nseqs'  : len(names[r]),
+                  'nblks'  : len(blks[r]),
+                  'length' : sum(len(G.blks[id]) for id in blks[r])} for r in names]
 
-        return [component(graph, name) for graph, name in zip(graphs, names)]
+        return [component(blks[r], names[r]) for r in names], sizes
 
     @classmethod
     def fuse(cls, g1, g2):
@@ -182,224 +230,276 @@ class Graph(object):
         isolates = set(isolates)
         G.seqs   = {iso:deepcopy(path) for iso, path in self.seqs.items() if iso in isolates}
         G.blks   = {blk.id:blk.marginalize(*isolates) for blk in set.union(*[p.blocks() for p in G.seqs.values()])}
-        G.remove_transitives()
+        G.remove_transitives(full=True)
         return G
 
-    def union(self, qpath, rpath, out, cutoff=0, alpha=10, beta=2, extensive=False, edge_window=1000, edge_extend=2500):
+    # qry and ref are the ids of the blocks mapped against each other.
+    # a self-map is requested by passing the same set of blocks twice; passing a
+    # subset of ref as qry only remaps those blocks against the rest of the graph.
+    # returns the ids of the blocks created by this round (empty if nothing was merged).
+    # stream > 0 consumes the hits while the aligner runs: they are buffered in a priority queue
+    # keyed on energy and whenever it holds more than stream hits, the best ones are merged.
+    def union(self, qry, ref, out, cutoff=0, alpha=10, beta=2, extensive=False, edge_window=1000, edge_extend=2500, aligner="minimap2", nprocs=1, stream=0):
         from seqanpy import align_global as align
 
         # ----------------------------------
         # internal functions
 
-        def energy(hit):
-            l    = hit["aligned_bases"]
-            if l <= cutoff:
-                return l
-
-            num  = lambda k: len(self.blks[hit[k]["name"]].muts)
-            cuts = lambda k: (hit[k]['start'] > cutoff) + ((hit[k]['len']-hit[k]['end']) > cutoff)
+        # energies of all hits of a utils.Hits table. hits with negative energy are accepted.
+        def energy(paf):
+            T    = paf.table
+            l    = T["aligned_bases"]
+            cuts = lambda k: (T[f'{k}_start'] > cutoff).astype(int) + ((T[f'{k}_len']-T[f'{k}_end']) > cutoff)
 
             if extensive:
-                delP = num('qry')*cuts('qry') + num('ref')*cuts('ref')
+                num  = np.array([depth[name] for name in paf.names])
+                delP = num[T['qry']]*cuts('qry') + num[T['ref']]*cuts('ref')
             else:
                 delP = cuts('qry') + cuts('ref')
-            dmut = hit["aligned_length"] * hit["divergence"]
+            dmut = T["aligned_length"] * T["divergence"]
+
+            return np.where(l <= cutoff, l, -l + alpha*delP + beta*dmut)
+
+        # the query is taken in the orientation of the hit.
+        # reverse complementing only the slice avoids copying the whole block.
+        def qry_head(hit, l):
+            s = seqs[hit['qry']['name']]
+            return rev_cmpl(s[-l:]) if hit['orientation'] == Strand.Minus else s[0:l]
+
+        def qry_tail(hit, l):
+            s = seqs[hit['qry']['name']]
+            return rev_cmpl(s[0:l]) if hit['orientation'] == Strand.Minus else s[-l:]
+
+        def ref_head(hit, l):
+            return seqs[hit['ref']['name']][0:l]
+
+        def ref_tail(hit, l):
+            return seqs[hit['ref']['name']][-l:]
+
+        # end repair: overhangs shorter than the cutoff are absorbed into the hit.
+        # overhangs on only one sequence become an indel. overhangs on both need an
+        # alignment and are returned as jobs so that all hits of a round are aligned in one batch.
+        def overhangs(hit):
+            jobs = []
+
+            dS_q = hit['qry']['start']
+            dE_q = hit['qry']['len'] - hit['qry']['end']
+            dS_r = hit['ref']['start']
+            dE_r = hit['ref']['len'] - hit['ref']['end']
+
+            # Left side of match
+            if 0 < dS_q <= cutoff and (dS_r > cutoff or dS_r == 0):
+                hit['cigar'] = f"{dS_q}I" + hit['cigar']
+                hit['qry']['start'] = 0
+            elif 0 < dS_r <= cutoff and (dS_q > cutoff or dS_q == 0):
+                hit['cigar'] = f"{dS_r}D" + hit['cigar']
+                hit['ref']['start'] = 0
+            elif 0 < dS_q <= cutoff and 0 < dS_r <= cutoff:
+                jobs.append((hit, 'left', qry_head(hit, dS_q), ref_head(hit, dS_r)))
+
+            # Right side of match
+            if 0 < dE_q <= cutoff and (dE_r > cutoff or dE_r == 0):
+                hit['cigar'] += f"{dE_q}I"
+                hit['qry']['end'] = hit['qry']['len']
+            elif 0 < dE_r <= cutoff and (dE_q > cutoff or dE_q == 0):
+                hit['cigar'] += f"{dE_r}D"
+                hit['ref']['end'] = hit['ref']['len']
+            elif 0 < dE_q <= cutoff and 0 < dE_r <= cutoff:
+                jobs.append((hit, 'right', qry_tail(hit, dE_q), ref_tail(hit, dE_r)))
+
+            return jobs
+
+        def repair(job, aln):
+            hit, side, _, _ = job
+            if side == 'left':
+                hit['cigar'] = as_cigar(*aln) + hit['cigar']
+                hit['qry']['start'] = 0
+                hit['ref']['start'] = 0
+            else:
+                hit['cigar'] = hit['cigar'] + as_cigar(*aln)
+                hit['qry']['end'] = hit['qry']['len']
+                hit['ref']['end'] = hit['ref']['len']
+            hit['aligned_bases'] += len(aln[0])
+
+        def align_all(jobs, pool):
+            qs, rs = [j[2] for j in jobs], [j[3] for j in jobs]
+            if pool is not None and len(jobs) > 1:
+                return list(pool.map(align, qs, rs, chunksize=max(1, len(jobs)//(4*nprocs))))
+            return [align(q, r) for q, r in zip(qs, rs)]
+
+        # hits taken in one round share no blocks and the path edits of their merges are queued,
+        # see index_blks: the new blocks of all hits are independent and built in parallel.
+        # the seeds are drawn up front on both paths, the serial one builds each block lazily.
+        def blocks_all(hits, pool):
+            seeds = [randomseed() for _ in hits]
+            if pool is not None and len(hits) > 1:
+                alns  = [self.hit_alignment(hit) for hit in hits]
+                return list(pool.map(blocks_from_aln, alns, seeds, chunksize=max(1, len(hits)//(4*nprocs))))
+            return (blocks_from_aln(self.hit_alignment(hit), seed) for hit, seed in zip(hits, seeds))
 
-            return -l + alpha*delP + beta*dmut
+        # ----------------------------------
+        # body
 
-        def accepted(hit):
-            return energy(hit) < 0
+        # blocks are taken in the order of self.blks, never in set order: the aligner input, and
+        # with it the resulting graph, does not depend on the hash seed.
+        qset, rset = set(qry), set(ref)
+        qry, ref   = [b for b in self.blks if b in qset], [b for b in self.blks if b in rset]
+        both       = [b for b in self.blks if b in qset or b in rset]
+        selfmap    = qset == rset
+
+        # block sequences are converted once and shared by the aligner and the end repair of all hits.
+        # NOTE: blocks are used at most once per round, hence merges never invalidate an entry that is still read.
+        seqs  = {b:as_string(self.blks[b].seq) for b in both}
+        qseqs = {b:seqs[b] for b in qry}
+        rseqs = qseqs if selfmap else {b:seqs[b] for b in ref}
+
+        # pairs of blocks found in both qry and ref are mapped in both directions: only keep one.
+        def mirrored(paf):
+            T    = paf.table
+            inq  = np.array([name in qset for name in paf.names])
+            inr  = np.array([name in rset for name in paf.names])
+            rank = np.argsort(np.argsort(np.array(paf.names)))
+            return inq[T['ref']] & inr[T['qry']] & (rank[T['ref']] <= rank[T['qry']])
+
+        # candidate hits of a table in order of increasing energy
+        def candidates(paf):
+            E     = energy(paf)
+            order = np.argsort(E, kind='stable')
+            return E, order[(E[order] < 0) & ~mirrored(paf)[order]]
+
+        # greedily take the rows (paf, i) in order, each block is merged at most once.
+        def take(rows):
+            hits = []
+            for paf, i in rows:
+                q, r = paf.names[paf.table['qry'][i]], paf.names[paf.table['ref'][i]]
+                if q in merged_blks or r in merged_blks:
+                    continue
 
-        if cutoff <= 0:
-            def proc(hit):
-                return hit
-        else:
-            def proc(hit):
-                # -----------------------
-                # load in sequences
+                hits.append(paf.hit(i))
+                merged_blks.add(r)
+                merged_blks.add(q)
+            return hits
 
-                with open(f"{qpath}.fa", 'r') as fd:
-                    qfa = {s.id:str(s.seq) for s in SeqIO.parse(fd, 'fasta')}
+        def apply(hits, pool):
+            if cutoff > 0:
+                jobs = [job for hit in hits for job in overhangs(hit)]
+                for job, aln in zip(jobs, align_all(jobs, pool)):
+                    repair(job, aln[1:])
 
-                if qpath == rpath:
-                    rfa = qfa
-                else:
-                    with open(f"{rpath}.fa", 'r') as fd:
-                        rfa = {s.id:str(s.seq) for s in SeqIO.parse(fd, 'fasta')}
-
-                # -----------------------
-                # internal functions
-
-                def to_cigar(aln):
-                    cigar = ""
-                    s1, s2 = np.fromstring(aln[0], dtype=np.int8), np.fromstring(aln[1], dtype=np.int8)
-                    M, I, D = 0, 0, 0
-                    for (c1, c2) in zip(s1, s2):
-                        if c1 == ord("-") and c2 == ord("-"):
-                            breakpoint("panic")
-                        elif c1 == ord("-"):
-                            if I > 0:
-                                cigar += f"{I}I"
-                                I = 0
-                            elif M > 0:
-                                cigar += f"{M}M"
-                                M = 0
-                            D += 1
-                        elif c2 == ord("-"):
-                            if D > 0:
-                                cigar += f"{D}D"
-                                D = 0
-                            elif M > 0:
-                                cigar += f"{M}M"
-                                M = 0
-                            I += 1
-                        else:
-                            if D > 0:
-                                cigar += f"{D}D"
-                                D = 0
-                            elif I > 0:
-                                cigar += f"{I}I"
-                                I = 0
-                            M += 1
-                    if I > 0:
-                        cigar += f"{I}I"
-                        I = 0
-                    elif M > 0:
-                        cigar += f"{M}M"
-                        M = 0
-                    elif D > 0:
-                        cigar += f"{D}D"
-                        M = 0
-
-                    return cigar
-
-                def revcmpl_if(s, cond):
-                    if cond:
-                        return str(Seq.reverse_complement(Seq(s)))
-                    else:
-                        return s
-
-                def get_seqs():
-                    return qfa[hit['qry']['name']], rfa[hit['ref']['name']]
-
-                # -----------------------
-                # body
-
-                dS_q = hit['qry']['start']
-                dE_q = hit['qry']['len'] - hit['qry']['end']
-                dS_r = hit['ref']['start']
-                dE_r = hit['ref']['len'] - hit['ref']['end']
-
-                # Left side of match
-                if 0 < dS_q <= cutoff and (dS_r > cutoff or dS_r == 0):
-                    hit['cigar'] = f"{dS_q}I" + hit['cigar']
-                    hit['qry']['start'] = 0
-                elif 0 < dS_r <= cutoff and (dS_q > cutoff or dS_q == 0):
-                    hit['cigar'] = f"{dS_r}D" + hit['cigar']
-                    hit['ref']['start'] = 0
-                elif 0 < dS_q <= cutoff and 0 < dS_r <= cutoff:
-                    qseq, rseq = get_seqs()
-                    aln = align(revcmpl_if(qseq, hit['orientation']==Strand.Minus)[0:dS_q], rseq[0:dS_r])[1:]
-
-                    hit['cigar'] = to_cigar(aln) + hit['cigar']
-                    hit['qry']['start'] = 0
-                    hit['ref']['start'] = 0
-                    hit['aligned_bases'] += len(aln[0])
-
-                # Right side of match
-                if 0 < dE_q <= cutoff and (dE_r > cutoff or dE_r == 0):
-                    hit['cigar'] += f"{dE_q}I"
-                    hit['qry']['end'] = hit['qry']['len']
-                elif 0 < dE_r <= cutoff and (dE_q > cutoff or dE_q == 0):
-                    hit['cigar'] += f"{dE_r}D"
-                    hit['ref']['end'] = hit['ref']['len']
-                elif 0 < dE_q <= cutoff and 0 < dE_r <= cutoff:
-                    qseq, rseq = get_seqs()
-                    aln = align(revcmpl_if(qseq, hit['orientation']==Strand.Minus)[-dE_q:], rseq[-dE_r:])[1:]
-
-                    hit['cigar'] = hit['cigar'] + to_cigar(aln)
-                    hit['qry']['end'] = hit['qry']['len']
-                    hit['ref']['end'] = hit['ref']['len']
-                    hit['aligned_bases'] += len(aln[0])
-
-                return hit
+            for hit, blks in zip(hits, blocks_all(hits, pool)):
+                self.merge(hit, edge_window, edge_extend, blks)
+            return len(hits)
 
-        # ----------------------------------
-        # body
+        # block depths are fixed before the first merge removes any block
+        depth = {b:len(self.blks[b].muts) for b in both}
+        blks  = set(self.blks.keys())
 
-        os.system(f"minimap2 -t 2 -x asm20 -m 10 -n 2 -s 30 -D -c {rpath}.fa {qpath}.fa 1>{out}.paf 2>log")
+        merged_blks = set()
+        # a single pool serves every chunk of hits: workers are started once per union.
+        with ProcessPoolExecutor(max_workers=nprocs) if nprocs > 1 else nullcontext() as pool:
+            if stream > 0:
+                # blocks merged in one round are distinct: index them once and splice the paths at the end.
+                self.index_blks()
+                nhits, queue, merged = 0, [], 0
+                for paf in aligners.streams[aligner](qseqs, rseqs, out, stream):
+                    E, order = candidates(paf)
+                    for i in order:
+                        heapq.heappush(queue, (E[i], nhits + i, paf, i))
+                    nhits += len(paf)
+
+                    if len(queue) > stream:
+                        merged += apply(take(heapq.heappop(queue)[2:] for _ in range(len(queue) - stream)), pool)
+
+                merged += apply(take(heapq.heappop(queue)[2:] for _ in range(len(queue))), pool)
+                self.flush()
+
+                if nhits == 0:
+                    return self, []
+            else:
+                paf = aligners.backends[aligner](qseqs, rseqs, out)
+                if len(paf) == 0:
+                    return self, []
 
-        with open(f"{out}.paf") as fd:
-            paf = parse_paf(fd)
-        paf.sort(key = lambda x: energy(x))
+                E, order = candidates(paf)
 
-        merged_blks = set()
-        if len(paf) == 0:
-            return self, False
-
-        merged = False
-        for hit in paf:
-            if hit['qry']['name'] in merged_blks \
-            or hit['ref']['name'] in merged_blks \
-            or(hit['ref']['name'] <= hit['qry']['name'] and qpath == rpath) \
-            or not accepted(hit):
-                continue
-
-            merged = True
-            self.merge(proc(hit), edge_window, edge_extend)
-            merged_blks.add(hit['ref']['name'])
-            merged_blks.add(hit['qry']['name'])
+                self.index_blks()
+                merged = apply(take((paf, i) for i in order), pool)
+                self.flush()
 
+        # mutations are sorted: only the last one of each haplotype can point past the end of its block
         for b in self.blks.values():
             L = len(b.seq)
-            for mut in b.muts.values():
-                for x in mut.keys():
-                    if x >= L:
-                        import ipdb; ipdb.set_trace()
+            for tag, mut in b.muts.items():
+                if len(mut) > 0 and mut.pos[-1] >= L:
+                    raise ValueError(f"mutation of {tag} at {mut.pos[-1]} past the end of block {b.id} (length {L})")
 
         self.remove_transitives()
 
         for path in self.seqs.values():
             path.rm_nil_blks()
+        self.prune_blks()
 
-        return self, merged
+        if not merged:
+            return self, []
+
+        # merges never modify blocks in place: every changed block has a new id.
+        return self, [b for b in self.blks if b not in blks]
+
+    # a junction is a pair of adjacent blocks, keyed by ((blk id, strand), (blk id, strand)).
+    # returns the number of times each isolate passes through it. keys restricts the result
+    # to the given junctions. junctions are visited in sorted order, see changed_junctions.
+    def junctions(self, keys=None):
+        if keys is None:
+            keys = sorted(set(k for path in self.seqs.values() for k in path.junctions))
+
+        junctions = {}
+        for key in keys:
+            isos = {iso:self.seqs[iso].junctions[key] for iso in self.blks[key[0][0]].isolates if key in self.seqs[iso].junctions}
+            if len(isos) > 0:
+                junctions[key] = isos
+        return junctions
+
+    # junctions that changed since the last call: the paths record the junctions they edited and
+    # the blocks that lost haplotypes. any other junction was already checked and is unchanged.
+    # the keys are sorted: transitive junctions are merged, and new ids drawn, in a fixed order.
+    def changed_junctions(self):
+        keys, stale = set(), set()
+        for path in self.seqs.values():
+            keys.update(path.fresh)
+            stale.update(path.stale)
+            path.fresh, path.stale = set(), set()
 
-    # a junction is a pair of adjacent blocks.
-    def junctions(self):
-        junctions = defaultdict(list)
-        for iso, path in self.seqs.items():
-            if len(path.nodes) == 1:
-                continue
+        stale = {id for id in stale if id in self.blks}
+        for id in stale:
+            for iso in self.blks[id].isolates:
+                keys.update(k for k in self.seqs[iso].junctions if k[0][0] == id or k[1][0] == id)
 
-            for i, n in enumerate(path.nodes):
-                if path.circular or i > 0:
-                    j = Junction(path.nodes[i-1], n)
-                    junctions[j].append(iso)
-        return { k:dict(Counter(v)) for k, v in junctions.items() }
+        return sorted(k for k in keys if k[0][0] in self.blks and k[1][0] in self.blks)
 
-    def remove_transitives(self):
-        js = self.junctions()
+    # full rechecks every junction, e.g. after the isolates of blocks changed outside of the paths.
+    def remove_transitives(self, full=False):
+        js = self.junctions(None if full else self.changed_junctions())
         transitives = []
         for j, isos in js.items():
-            left_eq_right = self.blks[j.left.blk.id].isolates == self.blks[j.right.blk.id].isolates
-            left_eq_isos  = isos == self.blks[j.left.blk.id].isolates
+            left_eq_right = self.blks[j[0][0]].isolates == self.blks[j[1][0]].isolates
+            left_eq_isos  = isos == self.blks[j[0][0]].isolates
             if left_eq_right and left_eq_isos:
                 transitives.append(j)
 
         chains = {}
-        for j in transitives:
-            if j.left_id in chains and j.right_id in chains:
-                c1, c2 = chains[j.left_id], chains[j.right_id]
+        for l, r in transitives:
+            if l[0] in chains and r[0] in chains:
+                c1, c2 = chains[l[0]], chains[r[0]]
                 if c1 == c2:
                     continue
 
-                if j.left_blk==c1[-1] and j.right_blk==c2[0]:
+                if l==c1[-1] and r==c2[0]:
                     new_chain = c1 + c2
-                elif j.left_blk==c1[-1] and rev_blk(j.right_blk)==c2[-1]:
+                elif l==c1[-1] and rev_blk(r)==c2[-1]:
                     new_chain = c1 + [rev_blk(b) for b in c2[::-1]]
-                elif rev_blk(j.left_blk)==c1[0] and j.right_blk==c2[0]:
+                elif rev_blk(l)==c1[0] and r==c2[0]:
                     new_chain = [rev_blk(b) for b in c1[::-1]] + c2
-                elif rev_blk(j.left_blk)==c1[0] and rev_blk(j.right_blk)==c2[-1]:
+                elif rev_blk(l)==c1[0] and rev_blk(r)==c2[-1]:
                     new_chain = c2 + c1
                 else:
                     breakpoint("case not covered")
@@ -407,27 +507,27 @@ class Graph(object):
                 for b, _ in new_chain:
                     chains[b] = new_chain
 
-            elif j.left_id in chains:
-                c = chains[j.left_id]
-                if j.left_blk == c[-1]:
-                    c.append(j.right_blk)
-                elif rev_blk(j.left_blk) == c[0]:
-                    c.insert(0, rev_blk(j.right_blk))
+            elif l[0] in chains:
+                c = chains[l[0]]
+                if l == c[-1]:
+                    c.append(r)
+                elif rev_blk(l) == c[0]:
+                    c.insert(0, rev_blk(r))
                 else:
                     breakpoint("chains should be linear")
-                chains[j.right_id] = c
-            elif j.right_id in chains:
-                c = chains[j.right_id]
-                if j.right_blk == c[-1]:
-                    c.append(rev_blk(j.left_blk))
-                elif j.right_blk == c[0]:
-                    c.insert(0, j.left_blk)
+                chains[r[0]] = c
+            elif r[0] in chains:
+                c = chains[r[0]]
+                if r == c[-1]:
+                    c.append(rev_blk(l))
+                elif r == c[0]:
+                    c.insert(0, l)
                 else:
                     breakpoint("chains should be linear")
-                chains[j.left_id] = c
+                chains[l[0]] = c
             else:
-                chains[j.left_id]  = [j.left_blk, j.right_blk]
-                chains[j.right_id] = chains[j.left_id]
+                chains[l[0]] = [l, r]
+                chains[r[0]] = chains[l[0]]
 
         chains = list({id(c):c for c in chains.values()}.values())
 
@@ -447,36 +547,73 @@ class Graph(object):
             for b, _ in c:
                 self.blks.pop(b)
 
-    def prune_blks(self):
+    # occurrence index: block id -> {tag : index of the node in the path of tag[0]}.
+    # merge keeps it up to date and queues its changes to the paths; flush applies them.
+    # nodes created since the last flush are indexed as None.
+    def index_blks(self):
+        self.occs = defaultdict(dict)
+        for iso, path in self.seqs.items():
+            for i, n in enumerate(path.nodes):
+                self.occs[n.blk.id][(iso, n.num)] = i
+
+    def flush(self):
+        for path in self.seqs.values():
+            path.flush()
+        self.occs = None
+
+    # ids restricts the check to the given blocks; requires the occurrence index.
+    def prune_blks(self, ids=None):
+        if ids is not None and self.occs is not None:
+            for id in ids:
+                if len(self.occs.get(id, {})) == 0:
+                    self.occs.pop(id, None)
+                    self.blks.pop(id, None)
+            return
+
         blks = set()
         for path in self.seqs.values():
-            blks.update(path.blocks())
-        self.blks = {b.id:self.blks[b.id] for b in blks}
+            blks.update(b.id for b in path.blocks())
+        self.blks = {id:blk for id, blk in self.blks.items() if id in blks}
 
-    def merge(self, hit, window, extend):
+    # the aligned segments of the two blocks of a hit, as input to Block.from_aln
+    def hit_alignment(self, hit):
         old_ref = self.blks[hit['ref']['name']]
         old_qry = self.blks[hit['qry']['name']]
 
         # As we slice here, we DONT need to remember the starting position.
         # This is why in from_aln(aln) we set the start index to 0
-        ref = old_ref[hit['ref']['start']:hit['ref']['end']]
-        qry = old_qry[hit['qry']['start']:hit['qry']['end']]
+        # the segments are temporary: they draw no ids, hence the id streams do not depend on
+        # when the alignment is built, see union.blocks_all
+        ref = old_ref.slice(hit['ref']['start'], hit['ref']['end'], gen=False)
+        qry = old_qry.slice(hit['qry']['start'], hit['qry']['end'], gen=False)
 
         if hit["orientation"] == Strand.Minus:
-            qry = qry.rev_cmpl()
-
-        aln = {"ref_seq"     : as_string(ref.seq),
-               "qry_seq"     : as_string(qry.seq),
-               "cigar"       : hit["cigar"],
-               "ref_cluster" : ref.muts,
-               "qry_cluster" : qry.muts,
-               "ref_start"   : hit["ref"]["start"],
-               "ref_name"    : hit["ref"]["name"],
-               "qry_start"   : hit["qry"]["start"],
-               "qry_name"    : hit["qry"]["name"],
-               "orientation" : hit["orientation"]}
-
-        merged_blks, new_qrys, new_refs, shared_blks, blk_map = Block.from_aln(aln)
+            qry = qry.rev_cmpl(gen=False)
+
+        return {"ref_seq"     : ref.seq,
+                "qry_seq"     : qry.seq,
+                "cigar"       : hit["cigar"],
+                "ref_cluster" : ref.muts,
+                "qry_cluster" : qry.muts,
+                "ref_start"   : hit["ref"]["start"],
+                "ref_name"    : hit["ref"]["name"],
+                "qry_start"   : hit["qry"]["start"],
+                "qry_name"    : hit["qry"]["name"],
+                "orientation" : hit["orientation"]}
+
+    # blks optionally holds the result of Block.from_aln for the alignment of the hit
+    def merge(self, hit, window, extend, blks=None):
+        old_ref = self.blks[hit['ref']['name']]
+        old_qry = self.blks[hit['qry']['name']]
+
+        # merges outside of union are applied immediately
+        standalone = self.occs is None
+        if standalone:
+            self.index_blks()
+
+        if blks is None:
+            blks = Block.from_aln(self.hit_alignment(hit))
+        merged_blks, new_qrys, new_refs, shared_blks, blk_map = blks
         for merged_blk in merged_blks:
             self.blks[merged_blk.id] = merged_blk
 
@@ -497,9 +634,9 @@ class Graph(object):
                 self.blks[right.id] = right
                 new_blks.append((right, Strand.Plus, False))
 
-            for tag in blk.muts.keys():
-                path = self.seqs[tag[0]]
-                path.replace(blk, tag, new_blks, blk_map)
+            for tag, i in self.occs.pop(blk.id, {}).items():
+                for n in self.seqs[tag[0]].queue(i, blk, tag, new_blks, blk_map):
+                    self.occs[n.blk.id][(tag[0], n.num)] = None
 
             return new_blks
 
@@ -607,7 +744,9 @@ class Graph(object):
 
         # emit('left')
         # emit('right')
-        self.prune_blks()
+        self.prune_blks([old_ref.id, old_qry.id] + [b[0].id for b in new_blocks])
+        if standalone:
+            self.flush()
 
         return [b[0] for b in new_blocks]
 
@@ -617,12 +756,19 @@ class Graph(object):
             seq = seq.replace('-', '')
         return seq
 
+    # reconstructs the sequences of all (or the given) isolates as (name, sequence) pairs.
+    # isolates are built one at a time: at most one genome is held in memory.
+    def sequences(self, names=None):
+        names = self.seqs.keys() if names is None else names
+        for name in names:
+            yield name, self.seqs[name].sequence()
+
     def compress_ratio(self, extensive=False, name=None):
         unc = 0
         if name is None:
+            # path positions track the ungapped length: no need to reconstruct sequences
             for n in self.seqs:
-                seq  = self.extract(n)
-                unc += len(seq)
+                unc += len(self.seqs[n])
             cmp = np.sum([len(x) for x in self.blks.values()])
         else:
             cmp = np.sum([len(x) for x in self.blks.values() if name in x.muts])
@@ -632,42 +778,37 @@ class Graph(object):
     def contains(self, other):
         return set(other.seqs.keys()).issubset(set(self.seqs.keys()))
 
-    def pairwise_distance(self, weighted=False):
-        strings     = {iso: [(n.blk.id,n.strand) for n in path.nodes] for iso,path in self.seqs.items()}
-        suffix_tree = suffix.Tree(strings)
-        isos        = sorted(list(self.seqs.keys()))
-        N           = len(self.seqs)
-
-        if not weighted:
-            def kernel():
-                D = np.zeros((N,N))
-                for i, iso1 in enumerate(isos):
-                    for j, iso2 in enumerate(isos[:i]):
-                        matches    = suffix_tree.matches(iso1, iso2)
-                        num_events = len(matches)
-                        if num_events > 0:
-                            D[i,j] = num_events
-                        else:
-                            D[i,j] = np.infty
-                        D[j,i] = D[i,j]
-                return D
-        else:
-            def kernel():
-                D = np.zeros((N,N))
-                for i, iso1 in enumerate(isos):
-                    L1 = len(self.seqs[iso1])
-                    for j, iso2 in enumerate(isos[:i]):
-                        L2 = len(self.seqs[iso2])
-
-                        matches = suffix_tree.matches(iso1, iso2)
-                        length  = lambda name: sum(self.blks[b[0]].len_of(name, 0) for m in matches for b in m)
-                        f1, f2  = length(iso1)/L1, length(iso2)/L2
-
-                        D[i,j] = np.sqrt(f1*f2)
-                        D[j,i] = D[i,j]
-                return D
-
-        return (kernel(), isos)
+    def pairwise_distance(self, weighted=False, nprocs=1):
+        strings = {iso: [(n.blk.id,n.strand) for n in path.nodes] for iso,path in self.seqs.items()}
+        index   = suffix.Array(strings)
+        isos    = sorted(list(self.seqs.keys()))
+        N       = len(self.seqs)
+
+        # all maximal matches are found once, before the pairs are split between workers
+        index.sweep()
+
+        # length of each block in each isolate, looked up by the block index of the match tokens
+        weights = None
+        if weighted:
+            weights = {}
+            for iso in isos:
+                keys = sorted({index.alphabet[n.blk.id] for n in self.seqs[iso].nodes})
+                blks = [self.blks[index.letters[k]] for k in keys]
+                lens = [b.len_of(iso, 0) if (iso, 0) in b.muts else 0 for b in blks]
+                weights[iso] = (np.array(keys, dtype=np.int64), np.array(lens, dtype=np.int64), len(self.seqs[iso]))
+
+        if nprocs <= 1 or N < 3:
+            D = np.zeros((N,N))
+            fill_distances(D, index, isos, weights, range(N))
+            return (D, isos)
+
+        # rows are dealt out in turn: every batch gets a similar number of pairs
+        buf     = RawArray('d', N*N)
+        batches = [list(range(k, N, 4*nprocs)) for k in range(min(N, 4*nprocs))]
+        with ProcessPoolExecutor(max_workers=nprocs, initializer=init_distances, initargs=(index, isos, weights, buf)) as pool:
+            list(pool.map(distances_of, batches))
+
+        return (np.frombuffer(buf).reshape(N, N).copy(), isos)
 
     def to_json(self, wtr, minlen=500):
         J = {}
@@ -686,7 +827,7 @@ class Graph(object):
             aln = { J["Isolate_names"].index(iso) :
                     self.blks[b].extract(iso, num, strip_gaps=False) for iso, num in self.blks[b].muts }
             nodes[b] = {"ID"        : b,
-                        "Genomes"   : {"Consensus" : ''.join(self.blks[b].seq),
+                        "Genomes"   : {"Consensus" : as_string(self.blks[b].seq),
                                        "Alignment" : aln },
                         "Out_Edges" : [],
                         "In_Edges"  : []}
@@ -1,9 +1,10 @@
 import sys
 import numpy as np
 
-from collections import ChainMap
+from collections import Counter
 
-from .utils import Strand, log, breakpoint, new_strand, rev_cmpl
+from .block import Block, Mutations
+from .utils import Strand, log, breakpoint, new_strand, rev_cmpl, rev_cmpl_seq, as_string
 
 # ------------------------------------------------------------------------
 # Node class: one visit along a path
@@ -51,6 +52,9 @@ class Path(object):
         self.offset   = offset
         self.position = np.cumsum([0] + [n.length(name) for n in self.nodes])
         self.circular = circular
+        self.pending  = {} # queued replacements {node index : new nodes}, see queue
+        self.visits   = None # {(blk id, num) : node index}, rebuilt on demand after edits, see index_of
+        self.index_junctions()
 
         if offset > 0 and not circular:
             raise ValueError("sequence path cannot have non-zero offset if it corresponds to linear genome")
@@ -72,20 +76,57 @@ class Path(object):
         return set([n.blk for n in self.nodes])
 
     def sequence(self, verbose=False):
-        seq = ""
-        for n in self.nodes:
-            s = n.blk.extract(self.name, n.num, strip_gaps=True, verbose=verbose)
-            if n.strand == Strand.Plus:
-                seq += s
-            else:
-                seq += rev_cmpl(s)
+        def haplotype(n):
+            return n.blk.haplotype(self.name, n.num)
+
+        parts = [haplotype(n) if n.strand == Strand.Plus else rev_cmpl_seq(haplotype(n)) for n in self.nodes]
+        seq   = np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=np.uint8)
 
         if self.offset != 0:
             if not self.circular:
                 raise ValueError("invalid sequence path: non-zero offset for linear genome")
-            seq = seq[self.offset:] + seq[:self.offset]
-
-        return seq
+            seq = np.concatenate((seq[self.offset:], seq[:self.offset]))
+
+        return as_string(seq)
+
+    # ------------------
+    # junctions
+    # multiset of the pairs of adjacent nodes, keyed by ((blk id, strand), (blk id, strand)).
+    # junction i joins node i-1 to node i. a path with a single node has no junctions.
+    # every edit of the node list updates the multiset and records the keys it changed in
+    # fresh. stale holds the blocks that lost a haplotype of this path. see Graph.remove_transitives
+
+    def index_junctions(self):
+        self.junctions = Counter()
+        self.fresh     = set()
+        self.stale     = set()
+        self.count_junctions(self.junctions_at(range(len(self.nodes))), +1)
+
+    def junction(self, i):
+        l, r = self.nodes[i-1], self.nodes[i]
+        return ((l.blk.id, l.strand), (r.blk.id, r.strand))
+
+    # indices of the junctions that touch the nodes at idx
+    def junctions_at(self, idx):
+        n = len(self.nodes)
+        if n < 2:
+            return set()
+
+        js = {j % n for i in idx for j in (i, i+1)}
+        if not self.circular:
+            js.discard(0)
+        return js
+
+    def count_junctions(self, js, sign):
+        for i in js:
+            key = self.junction(i)
+            self.junctions[key] += sign
+            if self.junctions[key] == 0:
+                self.junctions.pop(key)
+            self.fresh.add(key)
+
+    # ------------------
+    # edits
 
     def rm_nil_blks(self):
         good, popped = [], set()
@@ -97,14 +138,27 @@ class Path(object):
                 if (self.name, n.num) not in n.blk.muts:
                     breakpoint("malformed mutation bookkeeping!")
                 n.blk.muts.pop((self.name, n.num))
+                self.stale.add(n.blk.id)
             else:
                 good.append(i)
 
             if not n.blk.has(self.name):
                 popped.add(n.blk.id)
 
+        if len(good) == len(self.nodes):
+            return
+
+        # the remaining nodes that follow a removed node are joined to a new neighbour
+        kept = np.zeros(len(self.nodes), dtype=bool)
+        kept[good] = True
+        self.count_junctions(self.junctions_at(np.flatnonzero(~kept)), -1)
+
         self.nodes    = [self.nodes[i] for i in good]
         self.position = np.cumsum([0] + [n.length(self.name) for n in self.nodes])
+        self.visits   = None
+
+        rejoined = {k for k, i in enumerate(good) if not kept[i-1] and (i > 0 or self.circular)}
+        self.count_junctions(rejoined & self.junctions_at(range(len(self.nodes))), +1)
 
     def merge(self, start, stop, new):
         N = 0
@@ -124,9 +178,11 @@ class Path(object):
                 if beg < end:
                     # print(f"----> case 1: {self.nodes[beg:end+1]} ({beg}, {end})")
                     # s0  = "".join(n.blk.extract(self.name, n.num) for n in self.nodes[beg:end+1])
-                    val = dict(ChainMap(*[new.muts[n.blk][(self.name,n.num)] for n in self.nodes[beg:end+1]]))
+                    val = Mutations.cat([new.muts[n.blk][(self.name,n.num)] for n in self.nodes[beg:end+1]])
                     new.muts.update({key:val})
+                    self.count_junctions(self.junctions_at(range(beg, end+1)), -1)
                     self.nodes = self.nodes[:beg] + [Node(new, N, s)] + self.nodes[end+1:]
+                    self.count_junctions(self.junctions_at([beg]), +1)
 
                     # s1 = new.extract(self.name,N)
                     # if s0 != s1:
@@ -137,46 +193,133 @@ class Path(object):
                     if not self.circular:
                         raise ValueError("attempted to rotate non-circular sequence")
                     self.offset += sum(n.blk.len_of(self.name, N) for n in self.nodes[beg:])
-                    val = dict(ChainMap(*[new.muts[n.blk][(self.name,n.num)] for n in self.nodes[beg:] + self.nodes[:end+1]]))
+                    val = Mutations.cat([new.muts[n.blk][(self.name,n.num)] for n in self.nodes[beg:] + self.nodes[:end+1]])
                     new.muts.update({key:val})
+                    self.count_junctions(self.junctions_at([*range(beg, len(self.nodes)), *range(end+1)]), -1)
                     self.nodes   = [Node(new, N, s)] + self.nodes[end+1:beg]
+                    self.count_junctions(self.junctions_at([0]), +1)
 
                     # s1 = new.extract(self.name, N)
                     # if s0 != s1:
                     #     breakpoint("bad rev-ordered mutations")
                 self.position  = np.cumsum([0] + [n.length(self.name) for n in self.nodes])
+                self.visits    = None
                 N += 1
             except ValueError as err:
                 print(f"Error: {err}")
                 return
 
+    # nodes that take the place of node n, a visit of blk, after blk was split into new_blks
+    def substitute(self, n, blk, tag, new_blks, blk_map):
+        os  = n.strand
+        mk  = lambda b,ns,merged: Node(b, blk_map[b.id][blk.id][tag][1], new_strand(os, ns)) if merged else Node(b, n.num, new_strand(os, ns))
+        tmp = [mk(blk,ns,flag) for blk, ns, flag in new_blks]
+        if os == Strand.Minus:
+            tmp = tmp[::-1]
+        return tmp
+
     def replace(self, blk, tag, new_blks, blk_map):
         new = []
         for n in self.nodes:
             if n.blk.id == blk.id and n.num == tag[1]:
-                os  = n.strand
-                mk  = lambda b,ns,merged: Node(b, blk_map[b.id][blk.id][tag][1], new_strand(os, ns)) if merged else Node(b, n.num, new_strand(os, ns))
-                tmp = [mk(blk,ns,flag) for blk, ns, flag in new_blks]
-                if os == Strand.Minus:
-                    tmp = tmp[::-1]
-                new.extend(tmp)
+                new.extend(self.substitute(n, blk, tag, new_blks, blk_map))
             else:
                 new.append(n)
 
         self.nodes    = new
         self.position = np.cumsum([0] + [n.length(self.name) for n in self.nodes])
-
+        self.visits   = None
+        self.index_junctions()
+
+    # as replace, for the node at index i. replacements are queued and applied together by flush.
+    # indices refer to the nodes as of the last flush. returns the new nodes.
+    def queue(self, i, blk, tag, new_blks, blk_map):
+        n = self.nodes[i]
+        if n.blk.id != blk.id or n.num != tag[1]:
+            raise ValueError(f"node {i} of {self.name} is not a visit of {blk.id}")
+
+        self.pending[i] = self.substitute(n, blk, tag, new_blks, blk_map)
+        return self.pending[i]
+
+    # splices all queued replacements in. only the lengths of new nodes are computed.
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        self.count_junctions(self.junctions_at(self.pending.keys()), -1)
+
+        length = np.diff(self.position)
+        nodes, lens, last = [], [], 0
+        added = []
+        for i in sorted(self.pending):
+            new = self.pending[i]
+            nodes.extend(self.nodes[last:i])
+            added.extend(range(len(nodes), len(nodes) + len(new)))
+            nodes.extend(new)
+            lens.append(length[last:i])
+            lens.append(np.array([n.length(self.name) for n in new], dtype=length.dtype))
+            last = i + 1
+        nodes.extend(self.nodes[last:])
+        lens.append(length[last:])
+
+        self.nodes    = nodes
+        self.position = np.cumsum(np.concatenate([np.zeros(1, dtype=length.dtype)] + lens))
+        self.pending  = {}
+        self.visits   = None
+
+        self.count_junctions(self.junctions_at(added), +1)
+
+    # ------------------
+    # coordinates
+    # position holds the start of every node along the path, before the rotation by offset.
+    # isolate coordinates are counted along the sequence returned by self.sequence.
+
+    # index of the node that is the visit num of blk, or None
+    def index_of(self, blk, num):
+        if self.visits is None:
+            self.visits = {(n.blk.id, n.num):i for i, n in enumerate(self.nodes)}
+        return self.visits.get((blk.id if isinstance(blk, Block) else blk, num))
+
+    # isolate coordinates [beg, end) of the visit num of blk, or None. on a circular isolate the
+    # node that wraps around its origin ends past its length L: it covers [beg, L) and [0, end-L).
     def position_of(self, blk, num):
-        index = { n.num:i for i, n in enumerate(self.nodes) if n.blk == blk }
-        if not num in index:
+        i = self.index_of(blk, num)
+        if i is None:
             return None
-        return (self.position[index[num]], self.position[index[num]+1])
+        L   = self.position[-1]
+        beg = (self.position[i] - self.offset) % L if L > 0 else self.position[i]
+        return (int(beg), int(beg + self.position[i+1] - self.position[i]))
 
     def orientation_of(self, blk, num):
-        orientation = { n.num:n.strand for i, n in enumerate(self.nodes) if n.blk == blk }
-        if not num in orientation:
+        i = self.index_of(blk, num)
+        if i is None:
             return None
-        return orientation[num]
+        return self.nodes[i].strand
+
+    # indices of the nodes covering the isolate coordinates pos and the offsets into them,
+    # counted along the isolate. see lift for offsets into the block haplotypes.
+    def locate_all(self, pos):
+        pos = np.asarray(pos, dtype=np.int64)
+        L   = self.position[-1]
+        if self.circular:
+            pos = (pos + self.offset) % L if L > 0 else pos
+        if np.any((pos < 0) | (pos >= L)):
+            raise IndexError(f"position out of range for sequence {self.name} of length {L}")
+
+        idx = np.searchsorted(self.position, pos, side='right') - 1
+        return idx, pos - self.position[idx]
+
+    def locate(self, pos):
+        idx, off = self.locate_all([pos])
+        return int(idx[0]), int(off[0])
+
+    # the block, visit number, strand and position within the block haplotype of the isolate coordinates pos
+    def lift(self, pos):
+        idx, off = self.locate_all(pos)
+        for i, o in zip(idx, off):
+            n = self.nodes[i]
+            l = self.position[i+1] - self.position[i]
+            yield n.blk.id, n.num, n.strand, int(o if n.strand == Strand.Plus else l - 1 - o)
 
     # TODO: pull out common functionality into a helper function
     # TODO: merge with other sequence function
@@ -3,7 +3,10 @@ import pickle
 import numpy as np
 import suffix_tree
 
-from .utils import Strand, Complement
+from itertools   import chain
+from collections import defaultdict, Counter
+
+from .utils import Strand, Complement, hash_powers, inverse_powers, seq_hash, prefix_hash
 
 def base(name):
     return name[:-4]
@@ -85,6 +88,54 @@ def issublist(qry, ref):
 
     return False
 
+# ------------------------------------------------------------------------
+# Rotation hashing
+# a match duplicates another if it, or its reverse complement, is found within the
+# other read cyclically, i.e. within m+m. all windows of m+m are hashed, see
+# utils.prefix_hash: the test is a set lookup instead of a scan.
+
+# hashes of all windows of length l
+def window_hash(P, l, inverse):
+    return (P[l:] - P[:len(P)-l]) * inverse[:len(P)-l]
+
+# indices of the matches kept, in order. rc returns the reverse complement of a match.
+# every kept match drops the matches found within it: if greedy only those after it,
+# otherwise all of them, see Tree.matches.
+def dedup(mums, rc, greedy=True):
+    alphabet = {}
+    def encode(m):
+        return tuple(alphabet.setdefault(c, len(alphabet)+1) for c in m)
+
+    fwds    = [encode(m) for m in mums]
+    powers  = hash_powers(2*max((len(c) for c in fwds), default=0) + 1)
+    inverse = inverse_powers(len(powers))
+
+    table = defaultdict(list) # (length, hash) -> [(index, codes)] of both directions
+    for j, m in enumerate(mums):
+        for c in (fwds[j], encode(rc(m))):
+            table[(len(c), int(seq_hash(np.array(c, dtype=np.uint64), powers)))].append((j, c))
+    hashes = defaultdict(list)
+    for l, h in table.keys():
+        hashes[l].append(h)
+    hashes = {l:np.array(hs, dtype=np.uint64) for l, hs in hashes.items()}
+
+    drop = set()
+    for i, c in enumerate(fwds):
+        if i in drop:
+            continue
+        cc = c + c
+        P  = prefix_hash(np.array(cc, dtype=np.uint64), powers)
+        for l, hs in hashes.items():
+            if l > len(cc):
+                continue
+            win = window_hash(P, l, inverse)
+            for k in np.flatnonzero(np.isin(win, hs)):
+                for j, o in table[(l, int(win[k]))]:
+                    if j not in drop and (j > i if greedy else j != i) and cc[k:k+l] == o:
+                        drop.add(j)
+
+    return [i for i in range(len(mums)) if i not in drop]
+
 def pprint(db):
     def convert(s):
         if s == Strand.Plus:
@@ -194,57 +245,47 @@ class Tree(object):
 
         xlen = min(len(self.seqs[arg]) for arg in args)
 
-        mums = []
+        # mums are indexed by node and by the items of their identity. n is skipped if the identity of
+        # an earlier mum is a subset of its own, and replaces an earlier mum that is its suffix link.
+        mums  = []
+        slot  = {}                # id(node) -> index in mums
+        items = defaultdict(set)  # identity item -> indices in mums
+        def put(i, n):
+            if i < len(mums):
+                del slot[id(mums[i])]
+                for item in mums[i].ident.items():
+                    items[item].discard(i)
+                mums[i] = n
+            else:
+                mums.append(n)
+            slot[id(n)] = i
+            for item in n.ident.items():
+                items[item].add(i)
+
         def pushmum(n):
             if plen(n) > xlen:
                 return
 
             if splits(n, *args):
-                for i, m in enumerate(mums):
-                    if n.suffix_link == m:
-                        mums[i] = n
-                        return
-
-                    # assert isparent(n,m) == isparent2(n,m), "failure of equivalency"
-                    if isparent2(n, m):
-                        return
-
-                mums.append(n)
+                hits = Counter(i for item in n.ident.items() for i in items.get(item, ()))
+                subs = [i for i, k in hits.items() if k == len(mums[i].ident)]
+                link = slot.get(id(n.suffix_link), len(mums))
+                if len(subs) > 0 and min(subs) < link:
+                    return
+                put(link, n)
 
         self.tree.root.post_order(pushmum)
 
         mums.sort(key = lambda m: plen(m), reverse=True)
 
-        # Remove reversed versions of the same match
-        def isrot(mum, other, reverse=False):
-            fwd = cat(mum, term=False)
-            rev = cat(other, term=False)
-
-            tot = fwd + fwd
-            if reverse:
-                return issublist(revcmp(rev), tot)
-            else:
-                return issublist(rev, tot)
-
-        delidx = set([])
-        for i, m in enumerate(mums):
-            if i in delidx:
-                continue
-
-            for j, o in enumerate(mums):
-                if j == i or j in delidx:
-                    continue
-                if isrot(m, o) or isrot(m, o, reverse=True):
-                    delidx.add(j)
-
-        for idx in sorted(delidx, reverse=True):
-            del mums[idx]
+        # Remove rotated and reversed versions of the same match
+        keep = dedup([cat(m, term=False) for m in mums], revcmp, greedy=False)
 
         def unpack(n):
             p = n.path
             return p.S[p.start:p.end]
 
-        return [unpack(m) for m in mums]
+        return [unpack(mums[i]) for i in keep]
 
     def todict(self):
         return {'strs':   self.strs,
@@ -252,6 +293,218 @@ class Tree(object):
                 'seqs':   self.seqs,
                 'seqlen': self.seqlen}
 
+# ------------------------------------------------------------------------
+# Generalized suffix array over integer encoded block strings
+# each block visit (id, strand) is a token 2*i + (strand == Minus); the reverse complement
+# of a token flips its lowest bit. as for Tree, every string is doubled to catch rotations
+# and added in both directions. strings are separated by unique sentinels above all tokens.
+
+def suffix_array(text):
+    n    = len(text)
+    rank = np.unique(text, return_inverse=True)[1].astype(np.int64)
+    sa   = np.argsort(rank, kind='stable')
+    k    = 1
+    while k < n:
+        nxt = np.full(n, -1, dtype=np.int64)
+        nxt[:n-k] = rank[k:]
+        sa  = np.lexsort((nxt, rank))
+        key = np.stack((rank[sa], nxt[sa]))
+        new = np.concatenate(([0], np.cumsum(np.any(key[:, 1:] != key[:, :-1], axis=0))))
+        rank[sa] = new
+        if new[-1] == n-1:
+            break
+        k *= 2
+    return sa
+
+# lcp[i] is the length of the common prefix of the suffixes sa[i-1] and sa[i]. see Kasai et al. (2001)
+def lcp_array(text, sa):
+    n    = len(text)
+    rank = np.empty(n, dtype=np.int64)
+    rank[sa] = np.arange(n)
+    lcp  = np.zeros(n, dtype=np.int64)
+
+    txt, sa, rank = text.tolist(), sa.tolist(), rank.tolist()
+    h = 0
+    for i in range(n):
+        if rank[i] > 0:
+            j = sa[rank[i]-1]
+            while i+h < n and j+h < n and txt[i+h] == txt[j+h]:
+                h += 1
+            lcp[rank[i]] = h
+            if h > 0:
+                h -= 1
+        else:
+            h = 0
+    return lcp
+
+def bits(x):
+    while x:
+        low = x & -x
+        yield low.bit_length() - 1
+        x ^= low
+
+class Array(object):
+    """
+    docstring for suffix array
+    """
+    def __init__(self, G):
+        self.seqs   = G
+        self.names  = list(G.keys())
+        self.index  = { s:i for i, s in enumerate(self.names) }
+        self.seqlen = { s:len(seq) for s, seq in self.seqs.items() }
+        self.mums   = None
+
+        self.alphabet = {}
+        for seq in G.values():
+            for c in seq:
+                if c[0] not in self.alphabet:
+                    self.alphabet[c[0]] = len(self.alphabet)
+        self.letters = list(self.alphabet.keys())
+
+        strs, owner, first = [], [], []
+        for i, seq in enumerate(G.values()):
+            fwd = self.encode(seq)
+            rev = fwd[::-1] ^ 1
+            for s in (fwd, rev):
+                strs.append(np.concatenate((s, s[:-1], [2*len(self.letters) + len(strs)])))
+                owner.append(np.full(len(strs[-1]), i))
+                first.append(np.zeros(len(strs[-1]), dtype=bool))
+            first[-2][0] = True
+
+        self.text  = np.concatenate(strs) if len(strs) > 0 else np.zeros(0, dtype=np.int64)
+        self.owner = np.concatenate(owner) if len(owner) > 0 else np.zeros(0, dtype=np.int64)
+        self.first = np.concatenate(first) if len(first) > 0 else np.zeros(0, dtype=bool) # starts of forward strings
+        self.sa    = suffix_array(self.text) if len(self.text) > 0 else np.zeros(0, dtype=np.int64)
+        self.lcp   = lcp_array(self.text, self.sa)
+
+    def encode(self, seq):
+        return np.array([2*self.alphabet[c[0]] + (c[1] == Strand.Minus) for c in seq], dtype=np.int64)
+
+    def decode(self, tokens):
+        return [(self.letters[t >> 1], Strand.Minus if t & 1 else Strand.Plus) for t in tokens]
+
+    # finds the maximal matches of all pairs of strings in a single bottom-up sweep over the
+    # lcp intervals, i.e. the internal nodes of the suffix tree. a match of two strings is the
+    # label of a node with suffixes of both, truncated to the length x of the shorter string.
+    # a node of depth below x yields a match if none of its children holds both strings and
+    # the match can not be extended to the left. one of depth at least x yields a match if its
+    # parent is shallower than x.
+    # stores {(i, j) : [(start, length)]} for i < j in self.mums.
+    def sweep(self):
+        n    = len(self.sa)
+        lens = np.array([self.seqlen[nm] for nm in self.names], dtype=np.int64)
+        lenl = lens.tolist()
+
+        # isolates whose strings are at least d long
+        longs = {}
+        def longmask(d):
+            if d not in longs:
+                longs[d] = sum(1 << int(j) for j in np.flatnonzero(lens >= d))
+            return longs[d]
+
+        mums = {}
+        def push(a, b, start, length):
+            mums.setdefault((a, b) if a < b else (b, a), []).append((start, length))
+
+        # two strings of equal length x share a match of length x only if they are rotations of
+        # each other. it then appears once per rotation: only the nodes that contain the unrotated
+        # forward string of one of them are kept.
+        def visit(depth, parent, lb, mask, rot, left, kids):
+            if depth == 0 or mask & (mask-1) == 0:
+                return
+            start = int(self.sa[lb])
+
+            # strings longer than the node: deepest node that holds both, not preceded by the same token in both.
+            # the pairs held by a child or preceded by the same token form cliques. S is split into the
+            # classes of strings that belong to the same cliques: two classes pair up if no clique joins them.
+            S = mask & longmask(depth+1)
+            if S & (S-1):
+                cliques = [m & S for m in chain(kids, left.values())]
+                cliques = [m for m in cliques if m & (m-1)]
+                if not any(m == S for m in cliques):
+                    parts = [(S, 0)]
+                    for m in cliques:
+                        parts = [q for p, c in parts for q in ((p & m, c | m), (p & ~m, c)) if q[0]]
+                    for i, (p, c) in enumerate(parts):
+                        for q, _ in parts[i:]:
+                            if q & c:
+                                continue
+                            for a in bits(p):
+                                for b in bits(q & ~((1 << (a+1)) - 1) if q == p else q):
+                                    push(a, b, start, depth)
+
+            # strings that end within the edge into the node: the match is the whole shorter string
+            P = mask & longmask(parent+1)
+            E = P & ~longmask(depth+1)
+            for a in bits(E):
+                Q = P & ~(E & ((1 << (a+1)) - 1))
+                if not (rot >> a) & 1:
+                    Q &= ~(longmask(lenl[a]) & ~longmask(lenl[a]+1) & ~rot)
+                for b in bits(Q):
+                    push(a, b, start, min(lenl[a], lenl[b]))
+
+        # {token : isolates} of the tokens that precede the suffixes of a node. merged smaller into larger.
+        def merge(x, y):
+            if len(x) < len(y):
+                x, y = y, x
+            for c, m in y.items():
+                x[c] = x.get(c, 0) | m
+            return x
+
+        owner = self.owner[self.sa].tolist()
+        first = self.first[self.sa].tolist()
+        prev  = np.where(self.sa > 0, self.text[self.sa-1], -1).tolist()
+        lcp   = self.lcp.tolist()
+        # stack of open intervals [depth, left bound, isolate mask, rotation mask, preceding tokens, masks of inner children]
+        # suffix i-1 is placed once lcp[i] is known.
+        stack = [[0, 0, 0, 0, {}, []]]
+        for i in range(1, n+1):
+            h    = lcp[i] if i < n else 0
+            leaf = 1 << owner[i-1]
+            rot  = leaf if first[i-1] else 0
+            if h > stack[-1][0]:
+                stack.append([h, i-1, leaf, rot, {prev[i-1]:leaf}, []])
+                continue
+
+            top = stack[-1]
+            top[2] |= leaf
+            top[3] |= rot
+            top[4]  = merge(top[4], {prev[i-1]:leaf})
+            while h < stack[-1][0]:
+                depth, lb, mask, rot, left, kids = stack.pop()
+                visit(depth, max(h, stack[-1][0]), lb, mask, rot, left, kids)
+                if h <= stack[-1][0]:
+                    top = stack[-1]
+                    top[2] |= mask
+                    top[3] |= rot
+                    top[4]  = merge(top[4], left)
+                    top[5].append(mask)
+                else:
+                    stack.append([h, lb, mask, rot, left, [mask]])
+
+        self.mums = mums
+
+    # matches of two distinct strings as lists of tokens
+    def tokens(self, a, b):
+        if self.mums is None:
+            self.sweep()
+
+        i, j = sorted((self.index[a], self.index[b]))
+        mums = [self.text[s:s+d].tolist() for s, d in self.mums.get((i, j), [])]
+        mums.sort(key=len, reverse=True)
+
+        # remove rotated and reversed versions of the same match
+        return [mums[i] for i in dedup(mums, lambda m: [t ^ 1 for t in m[::-1]])]
+
+    def matches(self, *args):
+        if len(args) <= 1:
+            return None
+
+        if len(set(args)) == 1:
+            return self.seqs[args[0]]
+
+        return [self.decode(m) for m in self.tokens(*args[:2])]
+
 # ------------------------------------------------------------------------
 # Unit tests
 
@@ -3,20 +3,37 @@ import json
 
 from math import inf
 from copy import deepcopy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing    import RawArray
 
 import numpy as np
 import matplotlib.pylab as plt
 
 from Bio.Seq import Seq
 
-from .utils import Strand, log, flatten, panic, breakpoint, rev_cmpl
-from .graph import Graph
+from .       import block
+from .utils  import Strand, log, flatten, panic, breakpoint, rev_cmpl, as_seq, rev_cmpl_seq
+from .utils  import hash_powers, seq_hash, prefix_hash, HASH_BASE, HASH_MOD
+from .graph  import Graph
 
 # ------------------------------------------------------------------------
 # Global variables
 
 MAXSELFMAPS = 25
 
+# number of rows of Q evaluated at once by Tree.nj
+NJROWS = 64
+
+# levels of the reconstruction check run after each merge round
+#   full:    every isolate is reconstructed and compared to its input sequence
+#   sampled: as full, but only for a random subset of CHECKSAMPLE isolates
+#   hash:    the hash of every block haplotype is compared to the hash of the
+#            input segment it covers. haplotype hashes are reused across rounds.
+#   off:     no check
+CHECKLEVELS = ["off", "hash", "sampled", "full"]
+CHECKSAMPLE = 4
+
 # ------------------------------------------------------------------------
 # Helper functions
 
@@ -57,6 +74,203 @@ def to_list(dmtx):
 
     return dlst
 
+# ------------------------------------------------------------------------
+# Alignment functions
+# NOTE: these are defined at module level so that they can be run by worker processes
+
+# compares the hash of each path, put together from the hashes of its segments, against the
+# hash of its input sequence. cache holds hashes computed by previous calls on graphs of the
+# same clade: only scalars are kept, a prefix hash is built only to locate an inconsistency.
+def check_hashes(seqs, G, names, cache):
+    if 'powers' not in cache:
+        cache['powers'] = hash_powers(max((len(seqs[name]) for name in names), default=0) + 1)
+        cache['inputs'] = {}
+        cache['heads']  = {}
+        cache['haps']   = {}
+    powers, inputs, heads, haps = cache['powers'], cache['inputs'], cache['heads'], cache['haps']
+
+    # the concatenated path is the input x rotated by the offset of the path, x[k:] + x[:k].
+    # its hash follows from the hashes of x and of x[:k]:
+    #   H(x[k:] + x[:k]) = (H(x) - H(x[:k]))*p^-k + H(x[:k])*p^(L-k)
+    def rotated(name, offset):
+        seq = seqs[name]
+        L   = len(seq)
+        k   = (-offset) % L if L > 0 else 0
+        if name not in inputs:
+            inputs[name] = int(seq_hash(as_seq(seq), powers))
+        if (name, k) not in heads:
+            heads[(name, k)] = int(seq_hash(as_seq(seq[:k]), powers))
+        H, Hk = inputs[name], heads[(name, k)]
+        return ((H - Hk)*pow(int(HASH_BASE), -k, HASH_MOD) + Hk*int(powers[L-k])) % HASH_MOD
+
+    def segment(name, n):
+        key = (n.blk.id, name, n.num, n.strand)
+        if key not in haps:
+            hap = n.blk.haplotype(name, n.num)
+            if n.strand == Strand.Minus:
+                hap = rev_cmpl_seq(hap)
+            haps[key] = (len(hap), seq_hash(hap, powers))
+        return haps[key]
+
+    nerror = 0
+    for name in names:
+        path = G.seqs[name]
+
+        lens, hashes = zip(*(segment(name, n) for n in path.nodes)) if len(path.nodes) > 0 else ((), ())
+        pos = np.cumsum([0] + list(lens))
+        if pos[-1] != len(seqs[name]):
+            log(f"inconsistency: {name} reconstructed with length {pos[-1]}, expected {len(seqs[name])}")
+            nerror += 1
+            continue
+
+        parts = powers[pos[:-1]]*np.array(hashes, dtype=np.uint64)
+        if int(np.sum(parts, dtype=np.uint64)) == rotated(name, path.offset):
+            continue
+
+        # locate the inconsistent segments
+        H   = prefix_hash(np.roll(as_seq(seqs[name]), path.offset), powers)
+        bad = np.flatnonzero(parts != H[pos[1:]] - H[pos[:-1]])
+        for i in bad:
+            log(f"inconsistency: {name} at {pos[i]}-{pos[i+1]} in block {path.nodes[i].blk.id}")
+        nerror += max(1, len(bad))
+
+    return nerror
+
+# debugging function that will check reconstructed sequence against known real one.
+def check(seqs, G, level="full", cache=None, verbose=False):
+    if level == "off":
+        return
+
+    names = [name for name in seqs if name in G.seqs]
+    uncompressed_length = sum(len(seqs[name]) for name in names)
+    if level == "hash":
+        nerror = check_hashes(seqs, G, names, {} if cache is None else cache)
+        recs   = []
+    elif level == "sampled" and len(names) > CHECKSAMPLE:
+        nerror = 0
+        recs   = G.sequences(np.random.choice(names, CHECKSAMPLE, replace=False))
+    elif level in ["sampled", "full"]:
+        nerror = 0
+        recs   = G.sequences(names)
+    else:
+        raise ValueError(f"unrecognized check level '{level}'")
+
+    # sequences are reconstructed one isolate at a time
+    for name, rec in recs:
+        orig = seqs[name]
+        if orig != rec:
+            breakpoint("inconsistency")
+            nerror += 1
+
+            with open("test.fa", "w+") as out:
+                out.write(f">original\n{orig}\n")
+                out.write(f">reconstructed\n{rec}")
+
+            for i in range(len(orig)//100):
+                if (orig[i*100:(i+1)*100] != rec[i*100:(i+1)*100]):
+                    log("-----------------")
+                    log(f"O: {i} {orig[i*100:(i+1)*100]}")
+                    log(f"G: {i} {rec[i*100:(i+1)*100]}")
+
+                    diffs = [i for i in range(len(rec)) if rec[i] != orig[i]]
+                    pos   = [0]
+                    seq   = G.seqs[name]
+                    for nn in seq.nodes:
+                        pos.append(pos[-1] + len(G.blks[nn.blk.id].extract(name, nn.num)))
+                    pos = pos[1:]
+
+                    testseqs = []
+                    for nn in G.seqs[name].nodes:
+                        if nn.strand == Strand.Plus:
+                            testseqs.append("".join(G.blks[nn.blk.id].extract(name, nn.num)))
+                        else:
+                            testseqs.append("".join(rev_cmpl(G.blks[nn.blk.id].extract(name, nn.num))))
+
+    if nerror == 0:
+        log("all sequences correctly reconstructed")
+        tlen = np.sum([len(x) for x in G.blks.values()])
+        log(f"--- total graph length: {tlen}")
+        log(f"--- total input sequence: {uncompressed_length}")
+        log(f"--- compression: {uncompressed_length/tlen:1.2f}")
+    else:
+        raise ValueError("bad sequence reconstruction")
+
+# ------------------------------------------------------------------------
+# input sequences shared by the merges of Tree.align
+# the sequences of all leafs are packed once into a buffer shared with the worker
+# processes. a merge is only passed the names of its leafs and slices their sequences
+# out of the buffer.
+
+inputs = {}
+def init_inputs(buf, spans):
+    inputs.update(buf=np.frombuffer(buf, dtype=np.uint8), spans=spans)
+
+def pack_inputs(seqs):
+    spans, beg = {}, 0
+    for name, seq in seqs.items():
+        spans[name] = (beg, beg + len(seq))
+        beg        += len(seq)
+
+    buf = RawArray('B', beg)
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    for name, seq in seqs.items():
+        arr[spans[name][0]:spans[name][1]] = np.frombuffer(seq.encode(), dtype=np.uint8)
+    return buf, spans
+
+def input_seqs(names):
+    buf, spans = inputs['buf'], inputs['spans']
+    return {name:buf[spans[name][0]:spans[name][1]].tobytes().decode() for name in names}
+
+# merges the graphs of two sibling clades and self-maps the result until convergence.
+# leafs names the leafs below the clade: their input sequences are used for checking.
+# the block ids of a clade are drawn from a stream seeded by its name: the graph does not
+# depend on the process that computes it, nor on the order of the clades.
+def merge(name, tmpdir, leafs, graph1, graph2, min_blk_len, mu, beta, extensive, edge_window, edge_extend, aligner, verify="full", stream=0, nprocs=1):
+    cache = {}
+    seqs  = input_seqs(leafs)
+    block.reseed(name)
+
+    graph        = Graph.fuse(graph1, graph2)
+    graph, fresh = graph.union(graph1.blks, graph2.blks, f"{tmpdir}/{name}", min_blk_len, mu, beta, extensive, edge_window, edge_extend, aligner, nprocs, stream)
+
+    # the graphs of both children have already been self-mapped until convergence.
+    # hence only blocks created by the previous round need to be remapped.
+    for i in range(MAXSELFMAPS):
+        if len(fresh) == 0:
+            break
+        log(f"----> merge round {i}: remapping {len(fresh)}/{len(graph.blks)} blocks")
+        check(seqs, graph, verify, cache)
+        graph, fresh = graph.union(fresh, graph.blks, f"{tmpdir}/{name}_iter_{i}", min_blk_len, mu, beta, extensive, edge_window, edge_extend, aligner, nprocs, stream)
+
+    check(seqs, graph, verify, cache)
+    with open(f"{tmpdir}/{name}.fa", 'w') as fd:
+        graph.write_fasta(fd)
+    save_checkpoint(tmpdir, name, graph)
+
+    return graph
+
+# ------------------------------------------------------------------------
+# Checkpoints
+# every aligned clade is stored as {tmpdir}/{name}.json so that an interrupted
+# run can be resumed. deleting a checkpoint forces its clade to be recomputed.
+
+def checkpoint(tmpdir, name):
+    return f"{tmpdir}/{name}.json"
+
+def save_checkpoint(tmpdir, name, graph):
+    path = checkpoint(tmpdir, name)
+    # write to a temporary file first so that a crash never leaves a truncated checkpoint
+    with open(f"{path}.part", 'w') as fd:
+        json.dump(graph.to_dict(), fd)
+    os.replace(f"{path}.part", path)
+
+def load_checkpoint(tmpdir, name):
+    path = checkpoint(tmpdir, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as fd:
+        return Graph.from_dict(json.load(fd))
+
 # ------------------------------------------------------------------------
 # Clade and Tree classes
 
@@ -176,27 +390,62 @@ class Tree(object):
 
     # our own neighbor joining
     # Biopython implementation is WAY too slow.
+    # the distances are copied once into a buffer whose first m rows and columns hold the m
+    # nodes left to join: a joined pair takes the slot of one, the last row fills the other.
+    # row sums are updated after each join. every row also keeps the ids of the other nodes
+    # ordered by distance: Q is only evaluated on the head of each row that can still reach
+    # the best value found, as bounded by (m-2)*D[i,k] - R[i] - max(R) (see Simonsen et al.,
+    # rapidNJ). ties are broken as by the first minimum of the full Q matrix, using the rank
+    # of each node in the list of nodes left to join.
     @classmethod
     def nj(cls, mtx, names, verbose=False):
         # -----------------------------
         # internal functions
 
-        def q(D):
-            n = D.shape[0]
-            Q = (n-2)*D - (np.sum(D,axis=0,keepdims=True) + np.sum(D,axis=1,keepdims=True))
-            np.fill_diagonal(Q, np.inf)
-            return Q
-
-        def minpair(q):
-            i, j = np.unravel_index(np.argmin(q), q.shape)
-            qmin = q[i, j]
-            if i > j:
-                i, j = j, i
-            return (i, j), qmin
-
-        def pairdists(D, i, j):
-            n  = D.shape[0]
-            d1 = .5*D[i,j] + 1/(2*(n-2)) * (np.sum(D[i,:], axis=0) - np.sum(D[j,:], axis=0))
+        # orders the rows of all nodes left. entries of joined nodes are skipped when read
+        # and dropped when the rows are sorted again.
+        def sort_rows(m):
+            for s in range(0, m, NJROWS):
+                rows = np.arange(s, min(s+NJROWS, m))
+                d    = D[rows, :m].copy()
+                d[np.arange(len(rows)), rows] = np.inf
+                I[rows, :m-1] = ids[np.argsort(d, axis=1, kind='stable')[:, :m-1]]
+            width[:m] = m-1
+
+        def minpair(m):
+            top  = np.max(R[:m])
+            rows = np.arange(m)
+            best, pair = np.inf, None
+
+            k, B = 0, 4
+            while len(rows) > 0:
+                col   = np.arange(k, k+B)
+                valid = col[None, :] < width[rows, None]
+                cols  = slot[I[rows[:, None], np.minimum(col, I.shape[1]-1)[None, :]]]
+                valid = valid & (cols >= 0)
+                cols  = np.where(valid, cols, 0)
+                d     = D[rows[:, None], cols]
+                Q     = np.where(valid, (m-2)*d - R[rows, None] - R[cols], np.inf)
+
+                qmin = np.min(Q)
+                if qmin <= best and qmin < np.inf:
+                    r, c   = np.nonzero(Q == qmin)
+                    r, c   = rows[r], cols[r, c]
+                    lo, hi = np.minimum(rank[r], rank[c]), np.maximum(rank[r], rank[c])
+                    x      = np.lexsort((hi, lo))[0]
+                    if pair is None or qmin < best or (lo[x], hi[x]) < (rank[pair[0]], rank[pair[1]]):
+                        best, pair = qmin, (r[x], c[x]) if rank[r[x]] < rank[c[x]] else (c[x], r[x])
+
+                # the entries of a row are read in order of distance: a row is done once its bound passes best
+                last = np.max(np.where(valid, d, -np.inf), axis=1)
+                more = (k+B < width[rows]) & ((m-2)*last - R[rows] - top <= best)
+                rows = rows[more]
+                k, B = k+B, 2*B
+
+            return pair
+
+        def pairdists(i, j, m):
+            d1 = .5*D[i,j] + 1/(2*(m-2)) * (R[i] - R[j])
             d2 = D[i,j] - d1
 
             # remove negative branches while keeping total fixed
@@ -207,52 +456,76 @@ class Tree(object):
                 d1 -= d2
                 d2  = 0
 
-            dnew = .5*(D[i,:] + D[j,:] - D[i, j])
+            dnew = .5*(D[i,:m] + D[j,:m] - D[i,j])
             return d1, d2, dnew
 
-        def join(D, debug=False):
+        # moves node k to the free slot j
+        def move(k, j, m):
+            D[j, :m] = D[k, :m]
+            D[:m, j] = D[:m, k]
+            D[j, j]  = 0
+            I[j]     = I[k]
+            R[j], rank[j], width[j], ids[j] = R[k], rank[k], width[k], ids[k]
+            nodes[j] = nodes[k]
+            slot[ids[j]] = j
+
+        def join(m):
             nonlocal idx
-            Q = q(D)
-            (i, j), qmin = minpair(Q)
-            if debug:
-                q0min = min(flatten(Q[:]))
-                assert abs(qmin-q0min) < 1e-2, f"minimum not found correctly. returned {qmin}, expected {q0min}"
-                print(f"{D}\n--> Joining {i} and {j}. d={D[i,j]}")
-
-            node   = Clade(f"NODE_{idx:05d}", T.root, None, [T.root.child[i], T.root.child[j]])
+            i, j = minpair(m)
+            node = Clade(f"NODE_{idx:05d}", T.root, None, [nodes[i], nodes[j]])
 
-            d1, d2, dnew = pairdists(D, i, j)
+            d1, d2, dnew = pairdists(i, j, m)
             node.child[0].new_parent(node, d1)
             node.child[1].new_parent(node, d2)
 
-            D[i, :] = dnew
-            D[:, i] = dnew
-            D[i, i] = 0
-            D = np.delete(D, j, axis=0)
-            D = np.delete(D, j, axis=1)
-            T.root.child[i] = node
-            T.root.child.pop(j)
+            R[:m] += dnew - D[i, :m] - D[j, :m]
+            R[i]   = np.sum(dnew)
+            D[i, :m] = dnew
+            D[:m, i] = dnew
 
-            idx = idx + 1
+            slot[ids[i]], slot[ids[j]] = -1, -1
+            ids[i], nodes[i] = len(names) + idx, node
+            slot[ids[i]]     = i
+
+            rest     = np.delete(np.arange(m), (i, j))
+            width[i] = m-2
+            I[i, :m-2] = ids[rest[np.argsort(dnew[rest], kind='stable')]]
 
-            return D
+            if j != m-1:
+                move(m-1, j, m)
+
+            idx = idx + 1
 
         # -----------------------------
         # body
         assert len(names) == len(set(names)), "non-unique names found"
 
         T = Tree()
-        for name in names:
-            T.root.child.append(Clade(name, T.root, None, children=[]))
-        idx = 0
-
-        while mtx.shape[0] > 2:
+        nodes = [Clade(name, T.root, None, children=[]) for name in names]
+        idx   = 0
+
+        n     = len(names)
+        D     = np.array(mtx, dtype=np.float64)
+        R     = np.sum(D, axis=1)
+        rank  = np.arange(n)
+        ids   = np.arange(n)                       # slot -> node id
+        slot  = np.full(2*n, -1); slot[:n] = ids   # node id -> slot, -1 once joined
+        I     = np.zeros((n, max(n-1, 1)), dtype=np.int32)
+        width = np.zeros(n, dtype=np.int64)
+
+        m = n
+        sort_rows(m)
+        while m > 2:
             if verbose:
-                print(f"--> Matrix size={mtx.shape[0]}. Number of root child={len(T.root.child)}")
-            mtx = join(mtx)
-
-        assert mtx.shape[0] == 2
-        d = mtx[0, 1]
+                print(f"--> Matrix size={m}")
+            join(m)
+            m -= 1
+            if 2*m <= np.max(width[:m]):
+                sort_rows(m)
+
+        assert m == 2
+        d = D[0, 1]
+        T.root.child = [nodes[k] for k in np.argsort(rank[:2])]
         T.root.child[0].dist = d/2
         T.root.child[1].dist = d/2
 
@@ -299,103 +572,28 @@ class Tree(object):
         leafs = {n.name: n for n in self.get_leafs()}
         self.seqs = {leafs[name]:seq for name,seq in seqs.items()}
 
-    def align(self, tmpdir, min_blk_len, circular, mu, beta, extensive, edge_window, edge_extend, log_stats=False, verbose=False):
+    def align(self, tmpdir, min_blk_len, circular, mu, beta, extensive, edge_window, edge_extend, log_stats=False, verbose=False, nprocs=1, resume=False, aligner="minimap2", verify="full", stream=0):
         self.root.set_level(0) # NOTE: for debug logging
         stats = {}
         # ---------------------------------------------
         # internal functions
-        # debugging function that will check reconstructed sequence against known real one.
-        def check(seqs, G, verbose=False):
-            nerror = 0
-            uncompressed_length = 0
-            for n in self.get_leafs():
-                if n.name not in G.seqs:
-                    continue
 
-                seq  = seqs[n]
-                orig = str(seq[:]).upper()
-                rec  = G.extract(n.name)
-                uncompressed_length += len(orig)
-                if orig != rec:
-                    breakpoint("inconsistency")
-                    nerror += 1
-
-                    with open("test.fa", "w+") as out:
-                        out.write(f">original\n{orig}\n")
-                        out.write(f">reconstructed\n{rec}")
-
-                    for i in range(len(orig)//100):
-                        if (orig[i*100:(i+1)*100] != rec[i*100:(i+1)*100]):
-                            log("-----------------")
-                            log(f"O: {i} {orig[i*100:(i+1)*100]}")
-                            log(f"G: {i} {rec[i*100:(i+1)*100]}")
-
-                            diffs = [i for i in range(len(rec)) if rec[i] != orig[i]]
-                            pos   = [0]
-                            seq   = G.seqs[n.name]
-                            for nn in seq.nodes:
-                                pos.append(pos[-1] + len(G.blks[nn.blk.id].extract(n.name, nn.num)))
-                            pos = pos[1:]
-
-                            testseqs = []
-                            for nn in G.seqs[n.name].nodes:
-                                if nn.strand == Strand.Plus:
-                                    testseqs.append("".join(G.blks[nn.blk.id].extract(n.name, nn.num)))
-                                else:
-                                    testseqs.append("".join(rev_cmpl(G.blks[nn.blk.id].extract(n.name, nn.num))))
-
-            if nerror == 0:
-                log("all sequences correctly reconstructed")
-                tlen = np.sum([len(x) for x in G.blks.values()])
-                log(f"--- total graph length: {tlen}")
-                log(f"--- total input sequence: {uncompressed_length}")
-                log(f"--- compression: {uncompressed_length/tlen:1.2f}")
-            else:
-                raise ValueError("bad sequence reconstruction")
-
-        def merge(node1, node2):
-            if node1 != node2:
-                graph1, fapath1 = node1.graph, node1.fapath
-                graph2, fapath2 = node2.graph, node2.fapath
-                graph    = Graph.fuse(graph1, graph2)
-                graph, _ = graph.union(fapath1, fapath2, f"{tmpdir}/{n.name}", min_blk_len, mu, beta, extensive, edge_window, edge_extend)
-            else:
-                graph = node1.graph
-
-            for i in range(MAXSELFMAPS):
-                log(f"----> merge round {i}")
-                check(self.seqs, graph)
-                itr = f"{tmpdir}/{n.name}_iter_{i}"
-                with open(f"{itr}.fa", 'w') as fd:
-                    graph.write_fasta(fd)
-                graph, contin = graph.union(itr, itr, f"{tmpdir}/{n.name}_iter_{i}", min_blk_len, mu, beta, extensive, edge_window, edge_extend)
-                if not contin:
-                    return graph
-            return graph
+        def leafs_of(node):
+            return [l.name for l in node.postorder() if l.is_leaf()]
 
-        # --------------------------------------------
-        # body
-
-        if self.num_leafs() == 1:
-            return Graph()
+        # nprocs is the number of processes the task may use on its own
+        def task(node, nprocs):
+            print(f"+++LEVEL={node.level}+++")
+            node.fapath = f"{tmpdir}/{node.name}"
+            log(f"fusing {node.child[0].name} with {node.child[1].name} @ {node.name}")
+            return (node.name, tmpdir, leafs_of(node),
+                    *(c.graph for c in node.child),
+                    min_blk_len, mu, beta, extensive, edge_window, edge_extend, aligner, verify, stream, nprocs)
 
-        # fix trivial graphs onto the leafs
-        for i, n in enumerate(self.get_leafs()):
-            seq      = self.seqs[n]
-            n.graph  = Graph.from_seq(n.name, str(seq).upper(), circular)
-            n.fapath = f"{tmpdir}/{n.name}"
-            with open(f"{n.fapath}.fa", 'w') as fd:
-                n.graph.write_fasta(fd)
-
-        for n in self.postorder():
-            if n.is_leaf():
-                continue
-            print(f"+++LEVEL={n.level}+++")
-            n.fapath = f"{tmpdir}/{n.name}"
-            log(f"fusing {n.child[0].name} with {n.child[1].name} @ {n.name}")
-            n.graph = merge(*n.child)
+        def finish(node, graph):
+            node.graph = graph
             # delete references to children graphs for cleanup
-            for c in n.child:
+            for c in node.child:
                 if log_stats:
                     stats[c.name] = {
                         'length' : [b.length for b in c.graph.blks.values()],
@@ -403,22 +601,101 @@ class Tree(object):
                     }
                 c.graph = None
 
-            check(self.seqs, n.graph)
-            with open(f"{n.fapath}.fa", 'w') as fd:
-                n.graph.write_fasta(fd)
+            log((f"--> compression ratio: "
+                   f"{node.graph.compress_ratio()}"))
+            log((f"--> number of blocks: "
+                   f"{len(node.graph.blks)}"))
+            log((f"--> number of members: "
+                   f"{len(node.graph.seqs)}"))
+
+        # collect the clades that are already aligned: leafs and, if resuming, checkpointed clades.
+        # everything above them still needs to be computed.
+        # as for merge, the ids of a leaf are drawn from a stream seeded by its name: a resumed run
+        # never replays ids that are live in a restored checkpoint.
+        def restore(node):
+            if node.is_leaf():
+                block.reseed(node.name)
+                seq         = self.seqs[node]
+                node.graph  = Graph.from_seq(node.name, str(seq).upper(), circular)
+                node.fapath = f"{tmpdir}/{node.name}"
+                with open(f"{node.fapath}.fa", 'w') as fd:
+                    node.graph.write_fasta(fd)
+                return [node]
+
+            if resume:
+                graph = load_checkpoint(tmpdir, node.name)
+                if graph is not None:
+                    log(f"restored {node.name} from checkpoint")
+                    node.graph  = graph
+                    node.fapath = f"{tmpdir}/{node.name}"
+                    return [node]
+
+            todo.add(node)
+            return [n for c in node.child for n in restore(c)]
 
-                log((f"--> compression ratio: "
-                       f"{n.graph.compress_ratio()}"))
-                log((f"--> number of blocks: "
-                       f"{len(n.graph.blks)}"))
-                log((f"--> number of members: "
-                       f"{len(n.graph.seqs)}"))
+        # --------------------------------------------
+        # body
 
+        if self.num_leafs() == 1:
+            return Graph()
+
+        todo     = set()
+        finished = restore(self.root)
+
+        buf, spans = pack_inputs({l.name:str(seq).upper() for l, seq in self.seqs.items()})
+        init_inputs(buf, spans)
+
+        if nprocs <= 1:
+            for n in self.postorder():
+                if n not in todo:
+                    continue
+                finish(n, merge(*task(n, nprocs)))
+            return
+
+        # sibling subtrees are independent: submit each internal node to the
+        # pool as soon as all of its children have been aligned.
+        parent  = {c:n for n in self.postorder() for c in n.child}
+        waiting = {n:len(n.child) for n in todo}
+        running = {} # job -> (node, number of processes given to it)
+        queued  = deque()
+        inuse   = 0
+        with ProcessPoolExecutor(max_workers=nprocs, initializer=init_inputs, initargs=(buf, spans)) as pool:
+            # near the root few clades run concurrently: each is given an equal share of the
+            # processes that are not in use. clades wait in the queue while none are left.
+            def submit():
+                nonlocal inuse
+                while len(queued) > 0 and inuse < nprocs:
+                    share = max(1, (nprocs - inuse) // len(queued))
+                    node  = queued.popleft()
+                    running[pool.submit(merge, *task(node, share))] = (node, share)
+                    inuse += share
+
+            def ready(node):
+                if node not in parent:
+                    return
+                waiting[parent[node]] -= 1
+                if waiting[parent[node]] == 0:
+                    queued.append(parent[node])
+
+            for n in finished:
+                ready(n)
+            submit()
+
+            while len(running) > 0:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for job in done:
+                    n, share = running.pop(job)
+                    inuse   -= share
+                    finish(n, job.result())
+                    ready(n)
+                submit()
+
+    # splits the graph of the root into its connected components. returns them with their sizes.
     def collect(self):
         if not self.root.graph:
-            return None
-        self.root.graph = Graph.connected_components(self.root.graph)
-        return self.root.graph
+            return None, None
+        self.root.graph, sizes = Graph.connected_components(self.root.graph)
+        return self.root.graph, sizes
 
     def write_nwk(self, wtr):
         self.root.to_nwk(wtr)
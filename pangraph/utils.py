@@ -1,4 +1,4 @@
-import os, sys
+import os, sys, re
 import csv
 import gzip
 import numpy as np
@@ -63,6 +63,12 @@ wcpair = {
     'Z' : 'Z',
 }
 
+# lookup table: ascii code -> ascii code of the watson-crick pair.
+# characters without a pair (gaps, N) map onto themselves.
+wcpair_lut = np.arange(256, dtype=np.uint8)
+for nuc, cmpl in wcpair.items():
+    wcpair_lut[ord(nuc)] = ord(cmpl)
+
 def rev_cmpl(seq):
     if isinstance(seq,Seq):
         return str(Seq.reverse_complement(seq))
@@ -97,12 +103,23 @@ def log(msg, file=sys.stderr):
 def as_array(x):
     return np.array(list(x))
 
+# nucleotide sequences are stored as arrays of ascii codes (one byte per base)
+def as_seq(x):
+    if isinstance(x, np.ndarray) and x.dtype == np.uint8:
+        return x
+    return np.frombuffer(str(x).encode('ascii'), dtype=np.uint8)
+
 def as_string(x):
+    if isinstance(x, np.ndarray) and x.dtype == np.uint8:
+        return x.tobytes().decode('ascii')
     try:
         return x.view(f'U{x.size}')[0]
     except:
         return "".join(str(c) for c in x)
 
+def rev_cmpl_seq(x):
+    return wcpair_lut[x[::-1]]
+
 def flatten(x):
     return np.ndarray.flatten(x[:])
 
@@ -112,6 +129,47 @@ def cat(*args):
 def as_record(seq, name):
     return SeqRecord(Seq(seq), id=name, name=name, description="")
 
+# run-length encodes a pairwise alignment of qry against ref as a cigar string
+def as_cigar(qry, ref):
+    gap = ord('-')
+    q   = np.frombuffer(qry.encode(), dtype=np.uint8)
+    r   = np.frombuffer(ref.encode(), dtype=np.uint8)
+    if np.any((q == gap) & (r == gap)):
+        breakpoint("panic")
+
+    op = np.full(len(q), ord('M'), dtype=np.uint8)
+    op[q == gap] = ord('D')
+    op[r == gap] = ord('I')
+    if len(op) == 0:
+        return ""
+
+    beg = np.concatenate(([0], np.flatnonzero(np.diff(op)) + 1))
+    num = np.diff(np.append(beg, len(op)))
+    return "".join(f"{n}{chr(o)}" for n, o in zip(num, op[beg]))
+
+# position weighted polynomial hashes of ascii sequences. arithmetic wraps modulo 2^64.
+# a sequence placed at offset a of a longer one contributes powers[a]*seq_hash(seq).
+HASH_BASE = np.uint64(0x9E3779B97F4A7C15)
+HASH_MOD  = 1 << 64
+
+def hash_powers(n):
+    p    = np.full(n, HASH_BASE, dtype=np.uint64)
+    p[0] = 1
+    return np.cumprod(p, dtype=np.uint64)
+
+# element a maps the contribution of a sequence at offset a back to its hash
+def inverse_powers(n):
+    p    = np.full(n, np.uint64(pow(int(HASH_BASE), -1, HASH_MOD)), dtype=np.uint64)
+    p[0] = 1
+    return np.cumprod(p, dtype=np.uint64)
+
+def seq_hash(seq, powers):
+    return np.sum(seq.astype(np.uint64) * powers[:len(seq)], dtype=np.uint64)
+
+# element i holds the hash of seq[:i]
+def prefix_hash(seq, powers):
+    return np.concatenate((np.zeros(1, dtype=np.uint64), np.cumsum(seq.astype(np.uint64) * powers[:len(seq)], dtype=np.uint64)))
+
 # ------------------------------------------------------------------------
 # file handling
 
@@ -125,7 +183,10 @@ def mkdir(path):
     except:
         return 0
 
+# '-' is the standard input or output. it is not closed with the returned file.
 def openany(path, mode='r'):
+    if path == '-':
+        return open((sys.stdin if 'r' in mode else sys.stdout).fileno(), mode, closefd=False)
     if path.endswith('.gz'):
         if not mode.endswith('b'):
             mode += 't'
@@ -163,6 +224,39 @@ def as_str(s):
         return s.decode('utf-8')
     return s
 
+# disjoint-set forest with union by size and path halving.
+class DisjointSet(object):
+    """docstring for DisjointSet"""
+
+    def __init__(self):
+        self.parent = {}
+        self.size   = {}
+
+    def __contains__(self, x):
+        return x in self.parent
+
+    def add(self, x):
+        if x not in self.parent:
+            self.parent[x] = x
+            self.size[x]   = 1
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x == y:
+            return x
+        if self.size[x] < self.size[y]:
+            x, y = y, x
+        self.parent[y] = x
+        self.size[x]  += self.size.pop(y)
+        return x
+
 # ------------------------------------------------------------------------
 # parsers
 
@@ -222,132 +316,178 @@ def parse_paf(fh):
         hits.append(hit)
     return hits
 
+# columnar alternative to parse_paf. qry and ref index the name table of the hits.
+# absent divergence (de:f) and alignment score (AS:i) tags are stored as nan.
+PAF = np.dtype([('qry',             np.int32),
+                ('qry_len',         np.int64),
+                ('qry_start',       np.int64),
+                ('qry_end',         np.int64),
+                ('ref',             np.int32),
+                ('ref_len',         np.int64),
+                ('ref_start',       np.int64),
+                ('ref_end',         np.int64),
+                ('aligned_bases',   np.int64),
+                ('aligned_length',  np.int64),
+                ('mapping_quality', np.int64),
+                ('orientation',     np.int8),
+                ('divergence',      np.float64),
+                ('align_score',     np.float64)])
+
+class Hits(object):
+    """docstring for Hits"""
+
+    def __init__(self, rows=(), cigars=(), names=()):
+        self.table  = np.array(list(rows), dtype=PAF)
+        self.cigars = list(cigars)
+        self.names  = list(names)
+
+    def __len__(self):
+        return len(self.table)
+
+    # hit i in the format of parse_paf
+    def hit(self, i):
+        h   = self.table[i]
+        hit = {'qry': {'name'    : self.names[h['qry']],
+                       'len'     : int(h['qry_len']),
+                       'start'   : int(h['qry_start']),
+                       'end'     : int(h['qry_end'])},
+               'ref': {'name'    : self.names[h['ref']],
+                       'len'     : int(h['ref_len']),
+                       'start'   : int(h['ref_start']),
+                       'end'     : int(h['ref_end'])},
+               'aligned_bases'   : int(h['aligned_bases']),
+               'aligned_length'  : int(h['aligned_length']),
+               'mapping_quality' : int(h['mapping_quality']),
+               'orientation'     : Strand(int(h['orientation'])),
+               'cigar'           : self.cigars[i]}
+        if not np.isnan(h['divergence']):
+            hit['divergence'] = float(h['divergence'])
+        if not np.isnan(h['align_score']):
+            hit['align_score'] = float(h['align_score'])
+        return hit
+
+def parse_paf_table(fh):
+    index, rows, cigars = {}, [], []
+    def intern(name):
+        if name not in index:
+            index[name] = len(index)
+        return index[name]
+
+    for line in fh:
+        row  = line.split()
+        tags = {xtra[:2]:xtra[5:] for xtra in row[12:]}
+        rows.append((intern(row[0]), int(row[1]), int(row[2]), int(row[3]),
+                     intern(row[5]), int(row[6]), int(row[7]), int(row[8]),
+                     int(row[9]), int(row[10]), int(row[11]),
+                     Strand.Plus if row[4]=='+' else Strand.Minus,
+                     float(tags['de']) if 'de' in tags else np.nan,
+                     int(tags['AS']) / int(row[10]) if 'AS' in tags else np.nan))
+        cigars.append(tags.get('cg', ''))
+
+    return Hits(rows, cigars, index.keys())
+
+CIGAR = re.compile(r"(\d+)([MIDSH])")
+
+# decomposes the alignment of qryseq against refseq into blocks.
+# indels and clips at least cutoff long become blocks of their own.
+# returns the qry and ref interval of each block, or None when absent, and the blocks as
+#   (consensus, ((pos, val) of qry mutations, qry map), ((pos, val) of ref mutations, ref map))
+# the maps hold (x, offset) at the start of the block and after each operation, see Block.from_aln.
 def parse_cigar(aln, qryseq, refseq, cutoff=500):
-    from cigar import Cigar
-
-    aln = Cigar(aln)
-
-    lq, rq = 0, 0
-    lr, rr = 0, 0
-    refs = []
-    qrys = []
-    blks = []
-
-    R, Q = {}, {}
-    blkseq = ""
-    blkpos = 0
-    refmap = [(rr, blkpos-rr)]
-    qrymap = [(rq, blkpos-rq)]
-
-    def push(qval=None, rval=None):
-        nonlocal R, Q, blkseq, blkpos, refmap, qrymap
-        assert not (qval is None and rval is None)
-
-        def f(xs, x):
-            if x is None:
-                xs.append(None)
-                return True
-            else:
-                l, r = zip(x)
-                if l < r:
-                    xs.append(x)
-                    return True
-                return False
-
-        hasq = f(qrys, qval)
-        hasr = f(refs, rval)
-
-        if hasq or hasr:
-            assert len(qrys) == len(refs)
-            assert len(blkseq) > 0, "empty seq"
-            blks.append((np.array(list(blkseq)), (Q, np.array(qrymap).T), (R, np.array(refmap).T)))
-
-        R, Q = {}, {}
-        blkseq = ""
-        blkpos = 0
-        refmap = [(rr, blkpos-rr)]
-        qrymap = [(rq, blkpos-rq)]
-
-    def recordbp():
-        nonlocal blkpos, refmap, qrymap
-
-        blkpos = len(blkseq)
-        refmap.append((rr, blkpos-rr))
-        qrymap.append((rq, blkpos-rq))
-
-    for l, t in aln.items():
-        if t in ['S', 'H']:
-            if l >= cutoff:
-                print(aln)
-                import ipdb; ipdb.set_trace()
-
-                push((lq, rq), (lr, rr))
-
-                blkseq = qryseq[rq:rq+l]
-                # TODO: Think through soft/hard clips
-                # if t == 'S':
-                rq += l
-                recordbp()
-
-                push((rq-l, rq), None)
-                lq = rq
-                lr = rr
-            else:
-                rq += l
-                recordbp()
-
-        elif t == 'M':
-            rs = np.array(list(refseq[rr:rr+l]))
-            qs = np.array(list(qryseq[rq:rq+l]))
-            diff = np.where(np.array(rs != qs))[0]
-            for i in diff:
-                Q[i+blkpos] = qs[i]
-            blkseq += refseq[rr:rr+l]
-
-            rq += l
-            rr += l
-
-            recordbp()
-
-        elif t == 'D':
-            if l >= cutoff:
-                push((lq, rq), (lr, rr))
-
-                blkseq = refseq[rr:rr+l]
-                rr += l
-                recordbp()
-
-                push(None, (rr-l, rr))
-                lr = rr
-                lq = rq
-            else:
-                for i in range(l):
-                    Q[i+blkpos] = '-'
-                blkseq += refseq[rr:rr+l]
-
-                rr += l
-                recordbp()
-
-        elif t == 'I':
-            if l >= cutoff:
-                push((lq, rq), (lr, rr))
-
-                blkseq = qryseq[rq:rq+l]
-                rq += l
-                recordbp()
-
-                push((rq-l, rq), None)
-                lq = rq
-                lr = rr
-            else:
-                for i in range(l):
-                    R[i+blkpos] = '-'
-                blkseq += qryseq[rq:rq+l]
-
-                rq += l
-                recordbp()
-
-    push((lq, rq), (lr, rr))
-    assert len(qrys) == len(refs) and len(qrys) == len(blks)
+    qryseq = as_seq(qryseq) if isinstance(qryseq, str) else qryseq
+    refseq = as_seq(refseq) if isinstance(refseq, str) else refseq
+
+    ops = CIGAR.findall(aln)
+    if len(ops) == 0:
+        return [], [], []
+
+    # ------------------
+    # operation arrays
+
+    L  = np.array([int(l) for l, _ in ops], dtype=np.int64)
+    T  = np.array([t for _, t in ops])
+    M  = T == 'M'
+    D  = T == 'D'
+    I  = T == 'I'
+    SH = (T == 'S') | (T == 'H')
+
+    big = (D | I | SH) & (L >= cutoff)
+    if np.any(big & SH):
+        breakpoint(f"long clip in {aln}")
+
+    dq = np.where(M | I | SH, L, 0) # advance along qry
+    dr = np.where(M | D, L, 0)      # advance along ref
+    db = np.where(M | D | I | big, L, 0) # advance along the block
+
+    rq, rr, rb = np.cumsum(dq), np.cumsum(dr), np.cumsum(db)
+    lq, lr, lb = rq - dq, rr - dr, rb - db
+
+    # each long operation is a segment, as is each run of operations between them
+    first = np.copy(big)
+    first[0] = True
+    first[1:] |= big[:-1]
+    seg   = np.cumsum(first) - 1
+    start = np.flatnonzero(first)
+    stop  = np.append(start[1:], len(ops))
+
+    # ------------------
+    # concatenated sequence of all blocks
+
+    fromref = M | D
+    src = np.concatenate((refseq, qryseq))
+    off = np.where(fromref, lr, lq + len(refseq))
+
+    op  = np.repeat(np.arange(len(ops)), db)
+    idx = np.arange(rb[-1]) - lb[op]
+    seq = src[off[op] + idx]
+
+    # position of each base within its block
+    pos = np.arange(rb[-1]) - lb[start[seg[op]]]
+
+    # mismatches and gaps of qry and ref relative to the block
+    small = ~big[op]
+    ism   = M[op]
+    qbase = np.full(len(op), ord('-'), dtype=np.uint8)
+    qbase[ism] = qryseq[lq[op[ism]] + idx[ism]]
+
+    qmut = np.flatnonzero((ism & (qbase != seq)) | (small & D[op]))
+    qval = qbase[qmut]
+    rmut = np.flatnonzero(small & I[op])
+
+    # ------------------
+    # split into blocks
+
+    qrys, refs, blks = [], [], []
+    for s, e in zip(start, stop):
+        b0, b1 = lb[s], rb[e-1]
+        q0, q1 = int(lq[s]), int(rq[e-1])
+        r0, r1 = int(lr[s]), int(rr[e-1])
+
+        if big[s]:
+            qry = (q0, q1) if (I[s] or SH[s]) else None
+            ref = (r0, r1) if D[s] else None
+        else:
+            qry = (q0, q1) if q0 < q1 else None
+            ref = (r0, r1) if r0 < r1 else None
+            if qry is None and ref is None:
+                continue
+            assert qry is not None and ref is not None
+
+        assert b1 > b0, "empty seq"
+
+        blkpos = np.concatenate(([0], rb[s:e] - b0))
+        xq     = np.concatenate(([q0], rq[s:e]))
+        xr     = np.concatenate(([r0], rr[s:e]))
+        qrymap = np.array((xq, blkpos - xq))
+        refmap = np.array((xr, blkpos - xr))
+
+        i, j = np.searchsorted(qmut, (b0, b1))
+        Q = (pos[qmut[i:j]], qval[i:j])
+        i, j = np.searchsorted(rmut, (b0, b1))
+        R = (pos[rmut[i:j]], np.full(j-i, ord('-'), dtype=np.uint8))
+
+        qrys.append(qry)
+        refs.append(ref)
+        blks.append((seq[b0:b1], (Q, qrymap), (R, refmap)))
 
     return qrys, refs, blks
@@ -0,0 +1,51 @@
+import random
+import shutil
+import numpy as np
+import pytest
+
+from pangraph import aligner
+
+# ------------------------------------------------------------------------
+# the mappy and minimap2 backends return the same hits
+
+pytest.importorskip("mappy")
+if shutil.which("minimap2") is None:
+    pytest.skip("minimap2 is not installed", allow_module_level=True)
+
+def mutate(R, seq, rate=.02):
+    return "".join(R.choice("ACGT") if R.random() < rate else c for c in seq)
+
+# blocks that share segments in both orientations
+def fixture(seed):
+    R    = random.Random(seed)
+    rand = lambda n: "".join(R.choice("ACGT") for _ in range(n))
+    segs = [rand(R.randint(500, 2000)) for _ in range(4)]
+    rc   = lambda s: s[::-1].translate(str.maketrans("ACGT", "TGCA"))
+
+    qrys = {f"Q{i}":mutate(R, segs[i] + rand(300) + rc(segs[(i+1) % 4])) for i in range(3)}
+    refs = {f"R{i}":mutate(R, rand(200) + segs[i] + segs[(i+2) % 4]) for i in range(3)}
+    return qrys, refs
+
+# hits keyed by names instead of interned ids, in a fixed order
+def rows(paf):
+    T    = paf.table
+    cols = ['qry_len', 'qry_start', 'qry_end', 'ref_len', 'ref_start', 'ref_end',
+            'aligned_bases', 'aligned_length', 'mapping_quality', 'orientation']
+    hits = [(paf.names[T['qry'][i]], paf.names[T['ref'][i]], *(int(T[c][i]) for c in cols), paf.cigars[i], T['divergence'][i])
+            for i in range(len(paf))]
+    return sorted(hits, key=lambda h: h[:-1])
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("selfmap", [False, True])
+def test_backends_agree(tmp_path, monkeypatch, seed, selfmap):
+    monkeypatch.chdir(tmp_path)
+    qrys, refs = fixture(seed)
+    if selfmap:
+        qrys = refs = {**qrys, **refs}
+
+    mm2 = rows(aligner.backends["minimap2"](qrys, refs, f"{tmp_path}/out"))
+    mpy = rows(aligner.backends["mappy"](qrys, refs, f"{tmp_path}/out"))
+
+    assert len(mm2) > 0
+    assert [h[:-1] for h in mm2] == [h[:-1] for h in mpy]
+    assert np.allclose([h[-1] for h in mm2], [h[-1] for h in mpy], atol=1e-4)
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from pangraph.tree import Tree
+
+# ------------------------------------------------------------------------
+# Tree.nj against the O(n^3) neighbor joining it replaced
+
+# trees are compared as nested (name, ((dist, child), ...)) tuples
+def as_tuple(clade):
+    return (clade.name, tuple((round(c.dist, 9), as_tuple(c)) for c in clade.child))
+
+# joins the first minimum of the full Q matrix at every step
+def reference_nj(D, names):
+    D     = np.array(D, dtype=float)
+    nodes = [(name, ()) for name in names]
+    idx   = 0
+    while D.shape[0] > 2:
+        n = D.shape[0]
+        Q = (n-2)*D - (np.sum(D, axis=0, keepdims=True) + np.sum(D, axis=1, keepdims=True))
+        np.fill_diagonal(Q, np.inf)
+        i, j = sorted(np.unravel_index(np.argmin(Q), Q.shape))
+
+        d1 = .5*D[i,j] + 1/(2*(n-2)) * (np.sum(D[i,:]) - np.sum(D[j,:]))
+        d2 = D[i,j] - d1
+        if d1 < 0:
+            d2, d1 = d2 - d1, 0
+        if d2 < 0:
+            d1, d2 = d1 - d2, 0
+
+        dnew = .5*(D[i,:] + D[j,:] - D[i,j])
+        D[i,:], D[:,i], D[i,i] = dnew, dnew, 0
+        D = np.delete(np.delete(D, j, axis=0), j, axis=1)
+
+        nodes[i] = (f"NODE_{idx:05d}", ((round(d1, 9), nodes[i]), (round(d2, 9), nodes[j])))
+        nodes.pop(j)
+        idx += 1
+
+    d = round(D[0,1]/2, 9)
+    return ("ROOT", ((d, nodes[0]), (d, nodes[1])))
+
+# path length between every pair of leaves
+def patristic(tree):
+    depth, paths = {}, {}
+    def walk(node, d, path):
+        name, children = node
+        if len(children) == 0:
+            depth[name], paths[name] = d, path
+        for l, child in children:
+            walk(child, d + l, path + [(child[0], d + l)])
+    walk(tree, 0, [])
+
+    leaves = sorted(depth)
+    P = np.zeros((len(leaves), len(leaves)))
+    for a, x in enumerate(leaves):
+        for b, y in enumerate(leaves):
+            shared = [d for (u, d), (v, _) in zip(paths[x], paths[y]) if u == v]
+            P[a,b] = depth[x] + depth[y] - 2*(shared[-1] if shared else 0)
+    return P
+
+def random_integer(R, n):
+    D = R.integers(0, 5, (n, n)).astype(float)
+    D = D + D.T
+    np.fill_diagonal(D, 0)
+    return D
+
+# distances along a random tree with positive branches: neighbor joining recovers it exactly
+def random_additive(R, n):
+    D     = np.zeros((n, n))
+    nodes = [{i:0.} for i in range(n)]  # leaf -> depth below each node left to join
+    while len(nodes) > 1:
+        i, j   = R.choice(len(nodes), 2, replace=False)
+        li, lj = R.random() + .1, R.random() + .1
+        for x, dx in nodes[i].items():
+            for y, dy in nodes[j].items():
+                D[x,y] = D[y,x] = dx + li + lj + dy
+
+        node = {x:d + li for x, d in nodes[i].items()}
+        node.update({y:d + lj for y, d in nodes[j].items()})
+        nodes = [c for k, c in enumerate(nodes) if k != i and k != j] + [node]
+    return D
+
+@pytest.mark.parametrize("n", [2, 3])
+def test_nj_small(n):
+    D     = np.array([[0, 3, 5], [3, 0, 4], [5, 4, 0]], dtype=float)[:n, :n]
+    names = [f"s{i}" for i in range(n)]
+    assert as_tuple(Tree.nj(D.copy(), names).root) == reference_nj(D, names)
+
+@pytest.mark.parametrize("seed", range(100))
+def test_nj_ties(seed):
+    R     = np.random.default_rng(seed)
+    n     = int(R.integers(2, 30))
+    D     = random_integer(R, n)
+    names = [f"s{i}" for i in range(n)]
+    assert as_tuple(Tree.nj(D.copy(), names).root) == reference_nj(D, names)
+
+@pytest.mark.parametrize("seed", range(50))
+def test_nj_additive(seed):
+    R     = np.random.default_rng(seed)
+    D     = random_additive(R, int(R.integers(2, 40)))
+    names = [f"s{i:02d}" for i in range(D.shape[0])]
+
+    P = patristic(as_tuple(Tree.nj(D.copy(), names).root))
+    assert np.allclose(P, patristic(reference_nj(D, names)))
+    assert np.allclose(P, D)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from pangraph.block    import Block
+from pangraph.sequence import Node, Path
+from pangraph.utils    import Strand, rev_cmpl
+
+# ------------------------------------------------------------------------
+# coordinates of a rotated circular path
+
+# a circular isolate cut into blocks of random orientation, rotated by offset
+def rotated_path(seed):
+    R   = np.random.default_rng(seed)
+    seq = "".join(R.choice(list("ACGT"), 500))
+    cut = [0, *sorted(R.choice(np.arange(1, len(seq)), 5, replace=False)), len(seq)]
+
+    nodes = []
+    for beg, end in zip(cut[:-1], cut[1:]):
+        strand = Strand.Plus if R.random() < .5 else Strand.Minus
+        s      = seq[beg:end] if strand == Strand.Plus else rev_cmpl(seq[beg:end])
+        nodes.append(Node(Block.from_seq("iso", s), 0, strand))
+
+    offset = int(R.integers(1, len(seq)))
+    return Path("iso", nodes, offset, True), seq
+
+@pytest.mark.parametrize("seed", range(10))
+def test_position_of_round_trips(seed):
+    path, seq = rotated_path(seed)
+    iso = path.sequence()
+    assert iso == seq[path.offset:] + seq[:path.offset]
+
+    L = len(iso)
+    for i, n in enumerate(path.nodes):
+        beg, end = path.position_of(n.blk, n.num)
+        assert path.locate(beg) == (i, 0)
+        assert path.locate(end - 1) == (i, end - 1 - beg)
+
+        hap = n.blk.extract("iso", n.num)
+        hap = hap if n.strand == Strand.Plus else rev_cmpl(hap)
+        assert (iso + iso)[beg:end] == hap
+
+        blk, num, strand, pos = next(path.lift([beg]))
+        assert (blk, num, strand) == (n.blk.id, n.num, n.strand)
+        assert pos == (0 if n.strand == Strand.Plus else end - beg - 1)
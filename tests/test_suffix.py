@@ -0,0 +1,52 @@
+import random
+import pytest
+
+from pangraph        import suffix
+from pangraph.utils  import Strand
+
+# ------------------------------------------------------------------------
+# suffix.Array against the suffix tree it replaced
+
+# isolates are copies of a common cycle of blocks, each with a few substitutions,
+# deletions, reverse complements and rotations
+def random_graph(R):
+    nblks, niso = R.randint(2, 6), R.randint(2, 5)
+    block = lambda: (chr(ord('A') + R.randrange(nblks)), R.choice((Strand.Plus, Strand.Minus)))
+
+    base = [block() for _ in range(R.randint(2, 8))]
+    G    = {}
+    for i in range(niso):
+        s = list(base)
+        for _ in range(R.randint(0, 3)):
+            op, p = R.random(), R.randrange(len(s))
+            if op < .3:
+                s[p] = block()
+            elif op < .5 and len(s) > 1:
+                del s[p]
+            elif op < .7:
+                s = [(b, Strand.Minus if t == Strand.Plus else Strand.Plus) for b, t in s[::-1]]
+            else:
+                s = s[p:] + s[:p]
+        G[f"iso{i}"] = s
+    return G
+
+# matches are circular and unoriented: compare them up to rotation and reverse complement
+def canonical(match):
+    fwd = tuple((b, int(s)) for b, s in match)
+    rev = tuple((b, -s) for b, s in fwd[::-1])
+    return min(min(fwd[i:] + fwd[:i], rev[i:] + rev[:i]) for i in range(len(fwd)))
+
+def canonical_all(matches):
+    return sorted(canonical(m) for m in matches if len(m) > 0)
+
+@pytest.mark.parametrize("seed", range(100))
+def test_array_matches_tree(seed):
+    G = random_graph(random.Random(seed))
+    T = suffix.Tree(G)
+    A = suffix.Array(G)
+
+    for a in G:
+        for b in G:
+            if a >= b:
+                continue
+            assert canonical_all(A.matches(a, b)) == canonical_all(T.matches(a, b)), (G[a], G[b])
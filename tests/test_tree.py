@@ -0,0 +1,54 @@
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip("mappy")
+pytest.importorskip("seqanpy")
+
+from pangraph.tree import Tree
+
+# ------------------------------------------------------------------------
+# the graph built by Tree.align does not depend on the number of processes
+
+# related genomes: a common ancestor with substitutions, deletions and insertions
+def genomes(n, L, seed):
+    R    = np.random.default_rng(seed)
+    rand = lambda l: "".join(R.choice(list("ACGT"), l))
+    base = rand(L)
+
+    seqs = {}
+    for k in range(n):
+        s = np.array(list(base))
+        s[R.integers(0, L, 40)] = R.choice(list("ACGT"), 40)
+        s = "".join(s)
+        if k % 2:
+            p = R.integers(0, L-800)
+            s = s[:p] + s[p+600:]
+        if k % 3 == 0:
+            p = R.integers(0, len(s))
+            s = s[:p] + rand(700) + s[p:]
+        seqs[f"iso{k}"] = s
+    return seqs
+
+def build(tmpdir, seqs, circular, nprocs):
+    R = np.random.default_rng(0)
+    D = R.random((len(seqs), len(seqs)))
+    D = D + D.T
+    np.fill_diagonal(D, 0)
+
+    T = Tree.nj(D, list(seqs.keys()))
+    T.attach(seqs)
+    T.align(str(tmpdir), 100, circular, 100, 22, False, 100, 100, nprocs=nprocs, aligner="mappy")
+    with open(f"{tmpdir}/ROOT.json") as fd:
+        return json.load(fd)
+
+@pytest.mark.parametrize("circular", [False, True])
+def test_align_nprocs(tmp_path, monkeypatch, circular):
+    monkeypatch.chdir(tmp_path)
+    seqs = genomes(12, 6000, 5)
+    if circular:
+        seqs = {k:s[37*i:] + s[:37*i] for i, (k, s) in enumerate(seqs.items())}
+
+    (tmp_path/"j1").mkdir()
+    (tmp_path/"j2").mkdir()
+    assert build(tmp_path/"j1", seqs, circular, 1) == build(tmp_path/"j2", seqs, circular, 2)